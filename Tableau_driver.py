@@ -2,90 +2,212 @@
 
 ##### Tableau_driver.py
 
-import xml.etree.ElementTree as ET # Contains methods used to build and parse XML
+import threading
+import time
 import requests as r
+from requests.adapters import HTTPAdapter
 import tableauserverclient as TSC
+from tableauserverclient.server.endpoint.exceptions import NotSignedInError, ServerResponseError
 import pandas as pd
 
+from catalog import TableauCatalog
+from metrics import RunMetrics
+
 
 class Tableau:
-    def __init__(self, cfg):
+    def __init__(self, cfg, pool_size=10, metrics=None):
         self.cfg = cfg
+        self.metrics = metrics or RunMetrics()
         self.base_url = "{0}/api/{1}/".format(cfg.server,'3.23') # todo upravit hardcoded url
-        self.get_workbooks()
-
-    def _encode_for_display(self,text):
-        """
-        Encodes strings so they can display as ASCII in a Windows terminal window.
-        This function also encodes strings for processing by xml.etree.ElementTree functions.
+        self.pool_size = max(pool_size, 10)
+        self.token_ttl = cfg.tableau_token_ttl_min * 60
+        self.session = self._new_session()
+        self.site_id = None
+        self._server = None
+        self._signed_in_at = 0.0
+        self._lock = threading.Lock()
+        # download workers may be the first to need the catalog, it must be loaded only once
+        self._catalog_lock = threading.RLock()
+        self._catalog = None
+        # catalog loaded in full during this run – a miss in it is a real miss
+        self._catalog_full = False
+
+    @property
+    def catalog(self):
+        """Workbook/view catalog, loaded on first use only."""
+        with self._catalog_lock:
+            if self._catalog is None:
+                self.get_workbooks()
+            return self._catalog
+
+    def _new_session(self):
+        s = r.session()
+        # enough pooled connections for parallel attachment downloads
+        s.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+        s.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+        return s
 
-        Returns an ASCII-encoded version of the text.
-        Unicode characters are converted to ASCII placeholders (for example, "?").
-        """
-        return text.encode('ascii', errors="backslashreplace").decode('utf-8')
+    def _sign_in(self):
+        with self.metrics.phase("tableau_login", self.cfg.server):
+            self._authenticate()
+        print("Tableau server succesfully authorized.")
 
-    def login(self):
+    def _authenticate(self):
+        tableau_auth = TSC.PersonalAccessTokenAuth(self.cfg.tableau_token_name, self.cfg.tableau_token_secret, self.cfg.site)
+        # tableau_auth = TSC.TableauAuth(self.cfg.login, self.cfg.password, self.cfg.site)
+        if self._server is None:
+            # TSC calls and raw REST downloads share one pooled session
+            self._server = TSC.Server(self.cfg.server, session_factory=lambda: self.session)
+            self._server.auth.sign_in(tableau_auth)
+            self._server.use_server_version()
+        else:
+            self._server.auth.sign_in(tableau_auth)
+        self.site_id = self._server.site_id
+        self.session.headers['x-tableau-auth'] = self._server.auth_token
+        self._signed_in_at = time.monotonic()
 
-        xmlns = {'t': 'http://tableau.com/api'}
-        # Builds the request
-        xml_request = ET.Element('tsRequest')
-        credentials_element = ET.SubElement(xml_request,
-                                            'credentials',
-                                            personalAccessTokenName=self.cfg.tableau_token_name,
-                                            personalAccessTokenSecret=self.cfg.tableau_token_secret)
+    def refresh(self, stale_token=None):
+        """Signs in again, unless another thread already replaced `stale_token`."""
+        with self._lock:
+            if stale_token is None or self.session.headers.get('x-tableau-auth') == stale_token:
+                self._sign_in()
 
-        ET.SubElement(credentials_element, 'site', contentUrl=self.cfg.site)
-        xml_request = ET.tostring(xml_request)
-        s = r.session()
-        server_response = s.post(self.base_url + 'auth/signin', data=xml_request)
+    def auth_TSC(self):
+        with self._lock:
+            if self._server is None or time.monotonic() - self._signed_in_at > self.token_ttl:
+                self._sign_in()
+        return self._server
 
-        if server_response.status_code == 200:
-            print("Tableau server succesfully authorized.")
-        else:
-            raise Exception("Unable to login with server response:" + str(server_response.status_code) + server_response.text)
-
-        # ASCII encode server response to enable displaying to console
-        server_response = self._encode_for_display(server_response.text)
-        # Reads and parses the response
-        parsed_response = ET.fromstring(server_response)
-        # Gets the auth token and site ID
-        token = parsed_response.find('t:credentials', namespaces=xmlns).get('token')
-        self.site_id = parsed_response.find('.//t:site', namespaces=xmlns).get('id')
-        s.headers = {'x-tableau-auth': token}
-        return s
+    def call_TSC(self, func):
+        """
+        func(server) with a signed in TSC server. When the server rejects the token (revoked before
+        tableau_token_ttl_min ran out), signs in again and calls func once more.
+        """
+        server = self.auth_TSC()
+        token = server.auth_token
+        try:
+            return func(server)
+        except (ServerResponseError, NotSignedInError) as e:
+            if isinstance(e, ServerResponseError) and not str(e.code).startswith("401"):
+                raise
+            print(f"Tableau token rejected, signing in again: {e}")
+            self.refresh(stale_token=token)
+            return func(self._server)
 
-    def auth_TSC(self):
-        tableau_auth = TSC.PersonalAccessTokenAuth(self.cfg.tableau_token_name, self.cfg.tableau_token_secret, self.cfg.site)
-        # tableau_auth = TSC.TableauAuth(self.cfg.login, self.cfg.password, self.cfg.site)
-        server = TSC.Server(self.cfg.server)
-        server.auth.sign_in(tableau_auth)
-        server.use_server_version()
-        request_options = TSC.RequestOptions(pagesize=10000)
-        return server
-
-    def get_workbooks(self):
-        tmp_server= self.auth_TSC()
-        all_workbooks = list(TSC.Pager(tmp_server.workbooks))
-        workbooks = []
-        for workbook in all_workbooks:
-            workbooks.append([workbook.id, workbook.name, workbook.content_url, workbook.webpage_url,
-                          workbook.owner_id, workbook.created_at, workbook.updated_at,
-                          workbook.project_id, workbook.project_name, str([tag for tag in workbook.tags]),
-                          workbook.show_tabs, workbook.size, workbook.description])
-        self.workbooks = pd.DataFrame(workbooks)
-
-
-    def get_views_of_workbook(self,workbook_LUID):
-        tmp_server = self.auth_TSC()
+    def login(self):
+        self.auth_TSC()
+        return self.session
+
+    def get(self, url, params=None, **kwargs):
+        """GET on the REST API with the shared token, signs in again once when the token expired."""
+        self.auth_TSC()
+        token = self.session.headers.get('x-tableau-auth')
+        resp = self.session.get(url, params=params, **kwargs)
+        if resp.status_code == 401:
+            # streamed response would keep its pooled connection until garbage collected
+            resp.close()
+            self.refresh(stale_token=token)
+            resp = self.session.get(url, params=params, **kwargs)
+        return resp
+
+    def reload_catalog(self):
+        """Loads the whole catalog again, unless it was already loaded in full. True when it was reloaded."""
+        with self._catalog_lock:
+            if self._catalog_full:
+                return False
+            print("Name not found in incrementally refreshed Tableau catalog, loading full catalog.")
+            self.get_workbooks(full=True)
+            return True
+
+    def find_workbook(self, project, workbook):
+        """
+        LUIDs of workbooks by project/name. Renames of projects don't change updatedAt, so an incrementally
+        refreshed catalog may not know the new name yet – it is loaded in full once before giving up.
+        """
+        found = self.catalog.find_workbook(project, workbook)
+        if not found and self.reload_catalog():
+            found = self.catalog.find_workbook(project, workbook)
+        return found
+
+    def find_view(self, project, workbook, view):
+        found = self.catalog.find_view(project, workbook, view)
+        if not found and self.reload_catalog():
+            found = self.catalog.find_view(project, workbook, view)
+        return found
+
+    def invalidate_catalog(self):
+        """Next use of the catalog refreshes it from the state (long-running process)."""
+        with self._catalog_lock:
+            self._catalog = None
+            self._catalog_full = False
+
+    def list_ids(self, object_class):
+        """LUIDs of all workbooks/views on the site, paged over REST with `fields=id` only."""
+        self.auth_TSC()
+        ids = []
+        page_number = 1
+        while True:
+            resp = self.get(f"{self.base_url}sites/{self.site_id}/{object_class}",
+                            params={"fields": "id", "pageSize": 1000, "pageNumber": page_number},
+                            headers={"Accept": "application/json"})
+            if resp.status_code != 200:
+                raise Exception(f"Unable to list {object_class} with server response: {resp.status_code} {resp.text}")
+            body = resp.json()
+            items = body.get(object_class, {}).get(object_class[:-1], [])
+            ids.extend(item["id"] for item in items)
+            if not items or len(ids) >= int(body["pagination"]["totalAvailable"]):
+                return ids
+            page_number += 1
+
+    def existing_luids(self, object_class):
+        """LUIDs of workbooks/views on the site – from the catalog when it is loaded, otherwise listed over REST."""
+        if self._catalog is not None:
+            return self._catalog.workbooks.keys() if object_class == "workbooks" else self._catalog.views.keys()
+        return self.list_ids(object_class)
+
+    def get_workbooks(self, full=False):
+        with self._catalog_lock:
+            site_key = f"{self.cfg.server}/{self.cfg.site}"
+            stored = self.cfg.state.get("tableau_catalog")
+
+            catalog = None
+            if stored and stored.get("site") == site_key:
+                try:
+                    catalog = TableauCatalog.from_dict(stored)
+                except (KeyError, TypeError, ValueError) as e:
+                    print(f"Stored Tableau catalog is unusable, loading full catalog: {e}")
+
+            if full or catalog is None or catalog.is_stale(self.cfg.catalog_full_refresh_days):
+                with self.metrics.phase("catalog", "full"):
+                    catalog = self.call_TSC(lambda server: TableauCatalog().load(server))
+                self._catalog_full = True
+            else:
+                with self.metrics.phase("catalog", "incremental"):
+                    existing_ids = self.list_ids("workbooks")
+                    self.call_TSC(lambda server: catalog.refresh(server, existing_ids))
+
+            self._catalog = catalog
+            self.cfg.state.set("tableau_catalog", dict(catalog.to_dict(), site=site_key))
+            self.cfg.state.write()
+
+    def get_views_of_workbook(self, workbook_LUID, usage=False):
         ### return pd.DataFrame with all views datails for specified workbook_LUID
+        workbook = self.catalog.workbooks[workbook_LUID]
+        if not usage:
+            return pd.DataFrame([[workbook["id"], workbook["name"], view["id"], view["name"], view["content_url"],
+                                  view["sheet_type"], None] for view in self.catalog.views_of_workbook(workbook_LUID)])
+
+        def fetch(tmp_server):
+            #getting workbook object
+            the_workbook = tmp_server.workbooks.get_by_id(workbook_LUID)
+            #populating views
+            tmp_server.workbooks.populate_views(the_workbook, usage=True)
+            return the_workbook
+
         workbook_views = []
-        #getting workbook object
-        the_workbook = tmp_server.workbooks.get_by_id(workbook_LUID)
-        #populating views
-        tmp_server.workbooks.populate_views(the_workbook, usage=True)
+        the_workbook = self.call_TSC(fetch)
         #reshaping to the dataframe
         for view in the_workbook.views:
             workbook_views.append([the_workbook.id, the_workbook.name, view.id, view.name, view.content_url,
                                    view.sheet_type, view.total_views])
         return pd.DataFrame(workbook_views)
-
@@ -0,0 +1,100 @@
+"""
+Local stand-in for the Gmail API – OAuth token endpoint and `users.messages.send`.
+
+`service_account_info()` returns a service account with a freshly generated RSA key whose
+`token_uri` points here, so Gmail.gmail_login works unchanged; the Gmail client is pointed
+at the server with the `gmail_api_endpoint` parameter. Batch sends are not supported, the
+batch URL of googleapiclient can't be redirected.
+
+    gmail = FakeGmail(latency=0.05).start()
+    ... image_parameters "service_account_post": gmail.service_account_info(),
+        parameters "gmail_api_endpoint": gmail.url ...
+    gmail.stop()
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGmail:
+    def __init__(self, latency=0.05, port=0):
+        self.latency = latency
+        self.port = port
+        self.sent = 0
+        self.bytes_received = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.sent = self.bytes_received = self.tokens = 0
+
+    def service_account_info(self):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()).decode("ascii")
+        return {
+            "type": "service_account",
+            "project_id": "benchmark",
+            "private_key_id": uuid.uuid4().hex,
+            "#private_key": pem,
+            "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+            "client_id": "1",
+            "token_uri": f"{self.url}token",
+        }
+
+    def route(self, method, path, body):
+        if method == "POST" and path.startswith("/token"):
+            with self._lock:
+                self.tokens += 1
+            return 200, {"access_token": uuid.uuid4().hex, "expires_in": 3600, "token_type": "Bearer"}
+        if method == "POST" and path.split("?")[0].endswith("/messages/send"):
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+            raw = json.loads(body or b"{}").get("raw", "")
+            with self._lock:
+                self.sent += 1
+                self.bytes_received += len(raw)
+            return 200, {"id": uuid.uuid4().hex[:16], "threadId": uuid.uuid4().hex[:16], "labelIds": ["SENT"]}
+        return 404, {"error": {"code": 404, "message": f"Unknown path {path}"}}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, response = fake.route("POST", self.path, body)
+                payload = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
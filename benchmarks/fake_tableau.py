@@ -0,0 +1,187 @@
+"""
+Local stand-in for the Tableau Server REST API, enough for a full Driver run.
+
+Serves sign in/out and serverInfo (XML for tableauserverclient), paged workbook / view
+listings (XML, or JSON with `Accept: application/json` as used by Tableau.list_ids), views of
+a workbook and renders of views / workbooks (`.../pdf`, `.../image`) with configurable
+latency and payload size. With `max_renders` set, renders over that concurrency get 503.
+
+    server = FakeTableau(workbooks=20, views_per_workbook=5, latency=0.2, pdf_size=200 * 1024).start()
+    ... Configuration parameter "server": server.url ...
+    server.stop()
+"""
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import quoteattr
+
+API_VERSION = "3.23"
+NAMESPACE = "http://tableau.com/api"
+SITE_ID = "00000000-0000-0000-0000-0000000051e0"
+PROJECT_NAME = "Benchmark"
+
+
+def make_pdf(size):
+    """Valid one page PDF padded with an embedded file to roughly `size` bytes."""
+    from PyPDF2 import PdfWriter
+
+    writer = PdfWriter()
+    writer.add_blank_page(595, 842)
+    if size > 1024:
+        writer.add_attachment("padding.bin", os.urandom(size - 1024))
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+class FakeTableau:
+    def __init__(self, workbooks=20, views_per_workbook=5, latency=0.1, pdf_size=100 * 1024,
+                 image_size=50 * 1024, max_renders=None, port=0):
+        self.latency = latency
+        self.max_renders = max_renders
+        self.port = port
+        self.token = uuid.uuid4().hex
+        self.workbooks = [
+            {"id": f"{index:08d}-0000-0000-0000-00000000a0b0", "name": f"Workbook {index}",
+             "updatedAt": "2024-01-01T00:00:00Z"}
+            for index in range(workbooks)
+        ]
+        self.views = [
+            {"id": f"{index:08d}-{view:04d}-0000-0000-0000000000f0", "name": f"View {view}", "workbook": workbook}
+            for index, workbook in enumerate(self.workbooks) for view in range(views_per_workbook)
+        ]
+        self.payloads = {"pdf": make_pdf(pdf_size), "image": b"\xff\xd8\xff\xe0" + os.urandom(max(image_size - 4, 0))}
+        self.renders = 0
+        self.rejected = 0
+        self.bytes_sent = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.renders = self.rejected = self.bytes_sent = self.peak_in_flight = 0
+
+    # ---------- responses ----------
+
+    def render(self, kind):
+        with self._lock:
+            if self.max_renders is not None and self.in_flight >= self.max_renders:
+                self.rejected += 1
+                return 503, {"Retry-After": "1"}, b"Server busy"
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        payload = self.payloads["image" if kind == "image" else "pdf"]
+        with self._lock:
+            self.renders += 1
+            self.bytes_sent += len(payload)
+        return 200, {"Content-Type": "image/jpeg" if kind == "image" else "application/pdf"}, payload
+
+    def listing(self, object_class, items, query, as_json):
+        page_size = int(query.get("pageSize", ["100"])[0])
+        page_number = int(query.get("pageNumber", ["1"])[0])
+        page = items[(page_number - 1) * page_size:page_number * page_size]
+        pagination = {"pageNumber": str(page_number), "pageSize": str(page_size), "totalAvailable": str(len(items))}
+        if as_json:
+            body = {"pagination": pagination, object_class: {object_class[:-1]: [{"id": item["id"]} for item in page]}}
+            return 200, {"Content-Type": "application/json"}, json.dumps(body).encode("utf-8")
+        elements = "".join(self.workbook_xml(item) if object_class == "workbooks" else self.view_xml(item) for item in page)
+        attributes = " ".join(f'{key}="{value}"' for key, value in pagination.items())
+        return self.xml(f"<pagination {attributes}/><{object_class}>{elements}</{object_class}>")
+
+    @staticmethod
+    def workbook_xml(workbook):
+        return (f'<workbook id="{workbook["id"]}" name={quoteattr(workbook["name"])} contentUrl="wb{workbook["id"][:8]}" '
+                f'updatedAt="{workbook["updatedAt"]}"><project id="p1" name="{PROJECT_NAME}"/><owner id="u1"/></workbook>')
+
+    @staticmethod
+    def view_xml(view):
+        return (f'<view id="{view["id"]}" name={quoteattr(view["name"])} contentUrl="v{view["id"][:13]}" sheetType="dashboard">'
+                f'<workbook id="{view["workbook"]["id"]}"/><owner id="u1"/></view>')
+
+    @staticmethod
+    def xml(content):
+        body = f'<?xml version="1.0" encoding="UTF-8"?><tsResponse xmlns="{NAMESPACE}">{content}</tsResponse>'
+        return 200, {"Content-Type": "application/xml"}, body.encode("utf-8")
+
+    def route(self, method, path, query, headers):
+        if method == "POST" and path.endswith("/auth/signin"):
+            return self.xml(f'<credentials token="{self.token}"><site id="{SITE_ID}" contentUrl=""/><user id="u1"/></credentials>')
+        if method == "POST" and path.endswith("/auth/signout"):
+            return 204, {}, b""
+        if path.endswith("/serverInfo"):
+            return self.xml(f'<serverInfo><productVersion build="bench">2024.2</productVersion>'
+                            f'<restApiVersion>{API_VERSION}</restApiVersion></serverInfo>')
+        if headers.get("x-tableau-auth") != self.token:
+            return 401, {"Content-Type": "application/xml"}, b"<error>Not signed in</error>"
+
+        as_json = "application/json" in headers.get("Accept", "")
+        match = re.match(r"^/api/[\d.]+/sites/[^/]+/(workbooks|views)(?:/([^/]+)(?:/(.+))?)?$", path)
+        if not match:
+            return 404, {}, b"Not found"
+        object_class, object_id, action = match.groups()
+        if object_id is None:
+            return self.listing(object_class, self.workbooks if object_class == "workbooks" else self.views, query, as_json)
+        if object_class == "workbooks" and action == "views":
+            views = [view for view in self.views if view["workbook"]["id"] == object_id]
+            return self.xml(f"<views>{''.join(self.view_xml(view) for view in views)}</views>")
+        if action in ("pdf", "image"):
+            return self.render(action)
+        return 404, {}, b"Not found"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                parsed = urlparse(self.path)
+                status, headers, body = fake.route(method, parsed.path, parse_qs(parsed.query), self.headers)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of MIME assembly for the Gmail `raw` field.
+
+Compares the old path (msg.as_string() -> utf-8 -> base64url) with Gmail._mime_to_raw
+(bytes serialization encoded once). Reports time and peak traced memory per message.
+
+    python benchmarks/mime_encode.py [sizes in MB ...]
+"""
+import base64
+import os
+import sys
+import time
+import tracemalloc
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gmail import Gmail  # noqa: E402
+
+
+def build_message(size):
+    msg = MIMEMultipart()
+    msg.attach(MIMEText("Dobrý den, v příloze je report.", "plain"))
+    msg["Subject"] = "Benchmark"
+    msg["To"] = "to@example.com"
+    msg["From"] = "from@example.com"
+    return Gmail.attach_to_message(Gmail.__new__(Gmail), msg, os.urandom(size), "report.pdf", "pdf")
+
+
+def old_path(msg):
+    raw_message_string = msg.as_string()
+    return {"raw": base64.urlsafe_b64encode(raw_message_string.encode("utf-8")).decode("utf-8")}
+
+
+def new_path(msg):
+    return Gmail._mime_to_raw(msg)
+
+
+def measure(func, msg, repeat=3):
+    best = None
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        started = time.perf_counter()
+        func(msg)
+        elapsed = time.perf_counter() - started
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, peak
+
+
+def main(sizes_mb):
+    print(f"{'size':>6} | {'path':<10} | {'time ms':>8} | {'peak MB':>8} | {'peak / size':>11}")
+    for size_mb in sizes_mb:
+        msg = build_message(int(size_mb * 1024 * 1024))
+        assert old_path(msg) == new_path(msg)
+        for name, func in (("as_string", old_path), ("bytes", new_path)):
+            elapsed, peak = measure(func, msg)
+            print(f"{size_mb:>4} MB | {name:<10} | {elapsed * 1000:>8.1f} | {peak / 2 ** 20:>8.1f} | {peak / (size_mb * 2 ** 20):>11.2f}")
+
+
+if __name__ == "__main__":
+    main([float(arg) for arg in sys.argv[1:]] or [1, 5, 10, 20])
@@ -0,0 +1,75 @@
+"""
+Cold start benchmark – time until the component knows whether it has any work.
+
+Runs the component in fresh interpreters against a generated /data folder whose queue is
+empty (the common hourly run), and reports the median wall time of the whole process,
+of importing `driver` and of `Driver.__init__`, together with heavy modules that got loaded.
+
+    python benchmarks/startup.py [repeats]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["pandas", "requests", "tableauserverclient", "googleapiclient", "PyPDF2", "httplib2"]
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {repo!r})
+from driver import Driver
+imported = time.perf_counter()
+Driver({root!r}, {repo!r})
+initialized = time.perf_counter()
+print(json.dumps({{"import": imported - started, "init": initialized - imported,
+                  "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def make_data_dir():
+    root = tempfile.mkdtemp(prefix="startup_bench_")
+    os.makedirs(os.path.join(root, "in", "tables"))
+    os.makedirs(os.path.join(root, "out", "tables"))
+    # no timing window matches, so the queue is empty
+    with open(os.path.join(root, "config.json"), "w") as f:
+        json.dump({"parameters": {}, "image_parameters": {"timing": {}}}, f)
+    tables = {
+        "EMAILS.csv": "EMAIL_ID,GROUP_ID,MODE,PERIODICITY,PERIODICITY_SPECIFICATION,TIMING,MESSAGE,SUBJECT,OWNER,MERGE_ATTACHMENTS\n"
+                      "e1,g1,run,daily,,morning,Hi,Report,owner@example.com,no\n",
+        "EMAIL_SUBSCRIBERS.csv": "GROUP_ID,EMAIL,IS_ACTIVE,MESSAGE_LOADS,FILTER_PAYLOAD\n"
+                                 "g1,user@example.com,active,{},{}\n",
+        "EMAIL_ATTACHMENTS.csv": "EMAIL_ID,LUID,TABLEAU_OBJECT,ATTACHMENT_TYPE,WORKBOOK,VIEW,PROJECT,FILTER_FIELDS\n"
+                                 "e1,v1,view,pdf,W,V,P,\n",
+    }
+    for name, content in tables.items():
+        with open(os.path.join(root, "in", "tables", name), "w") as f:
+            f.write(content)
+    return root
+
+
+def main(repeats=5):
+    root = make_data_dir()
+    code = CHILD.format(repo=REPO, root=root, heavy=HEAVY_MODULES)
+    walls, imports, inits, heavy = [], [], [], []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        walls.append(time.perf_counter() - started)
+        result = json.loads(out.strip().splitlines()[-1])
+        imports.append(result["import"])
+        inits.append(result["init"])
+        heavy = result["heavy"]
+
+    print(f"empty queue, {repeats} runs (median): process {statistics.median(walls) * 1000:.0f} ms, "
+          f"import driver {statistics.median(imports) * 1000:.0f} ms, "
+          f"Driver() {statistics.median(inits) * 1000:.0f} ms")
+    print(f"heavy modules loaded: {', '.join(heavy) or 'none'}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,182 @@
+"""
+End-to-end Driver benchmark against local Tableau and Gmail stand-ins (no network, no credentials).
+
+For every scale a synthetic /data folder is generated – EMAILS, EMAIL_SUBSCRIBERS and
+EMAIL_ATTACHMENTS, config.json pointing to the local servers – and a full run
+(Driver(...).run(), as main.py does) is executed in a fresh process. Reported are emails/s,
+renders, peak RSS of the run and per-phase timings from RunMetrics.
+
+    python benchmarks/throughput.py [--scales small medium] [--render-latency 0.2] [--pdf-kb 200] \
+        [--param download_workers=8 --param execution_engine=pipeline ...]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gmail import FakeGmail  # noqa: E402
+from fake_tableau import PROJECT_NAME, FakeTableau  # noqa: E402
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# emails, subscribers per email group, attachments per email
+SCALES = {
+    "small": (10, 10, 2),
+    "medium": (40, 50, 2),
+    "large": (100, 200, 3),
+}
+REGIONS = 5
+
+# run parameters of the benchmark, --param overrides them
+DEFAULT_PARAMETERS = {
+    "gmail_send_rate": 0,
+    "checkpoint_deliveries": False,
+    "persistent_cache_dir": "",
+}
+
+CHILD = """
+import json, resource, sys, time
+sys.path.insert(0, {repo!r})
+started = time.perf_counter()
+from driver import Driver
+driver = Driver({root!r}, {repo!r})
+driver.run()
+elapsed = time.perf_counter() - started
+phases = {{}}
+for row in driver.metrics.rows:
+    phase = phases.setdefault(row["PHASE"], [0, 0.0, 0, 0])
+    phase[0] += 1
+    phase[1] += row["DURATION_MS"] / 1000
+    phase[2] += row["BYTES"]
+    phase[3] += row["RETRIES"]
+print(json.dumps({{"elapsed": elapsed, "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  "phases": phases}}))
+"""
+
+
+def generate_tables(directory, tableau, emails, subscribers, attachments, seed=0):
+    rng = random.Random(seed)
+    email_rows, subscriber_rows, attachment_rows = [], [], []
+    for index in range(emails):
+        email_id, group_id = f"E{index:05d}", f"G{index:05d}"
+        email_rows.append({
+            "EMAIL_ID": email_id, "GROUP_ID": group_id, "MODE": "run", "PERIODICITY": "daily",
+            "PERIODICITY_SPECIFICATION": "", "TIMING": "bench", "OWNER": "owner@example.com",
+            "SUBJECT": "Report {region}", "MESSAGE": "Dobrý den {name}, posíláme report za {region}.",
+            "MERGE_ATTACHMENTS": "merge" if index % 2 else "no",
+        })
+        for subscriber in range(subscribers):
+            subscriber_rows.append({
+                "GROUP_ID": group_id, "EMAIL": f"user{index}.{subscriber}@example.com", "IS_ACTIVE": "active",
+                "MESSAGE_LOADS": json.dumps({"name": f"User {subscriber}"}),
+                "FILTER_PAYLOAD": json.dumps({"region": f"R{subscriber % REGIONS}"}),
+            })
+        for view in rng.sample(tableau.views, attachments):
+            row = {"EMAIL_ID": email_id, "LUID": view["id"], "TABLEAU_OBJECT": "view",
+                   "ATTACHMENT_TYPE": rng.choice(["pdf", "pdf", "image"]), "WORKBOOK": view["workbook"]["name"],
+                   "VIEW": view["name"], "PROJECT": PROJECT_NAME, "FILTER_FIELDS": json.dumps(["region"])}
+            if rng.random() < 0.2:
+                # resolved by name through the catalog
+                row["LUID"] = ""
+            attachment_rows.append(row)
+
+    tables = os.path.join(directory, "in", "tables")
+    os.makedirs(tables, exist_ok=True)
+    pd.DataFrame(email_rows).to_csv(os.path.join(tables, "EMAILS.csv"), index=False)
+    pd.DataFrame(subscriber_rows).to_csv(os.path.join(tables, "EMAIL_SUBSCRIBERS.csv"), index=False)
+    pd.DataFrame(attachment_rows).to_csv(os.path.join(tables, "EMAIL_ATTACHMENTS.csv"), index=False)
+    return emails * subscribers
+
+
+def write_config(directory, tableau, gmail, service_account, parameters):
+    config = {
+        "parameters": dict({
+            "tableau_token_name": "benchmark", "#tableau_token_secret": "secret",
+            "server": tableau.url, "site": "", "gmail_address": "reports@example.com",
+            "gmail_api_endpoint": gmail.url,
+        }, **parameters),
+        "image_parameters": {
+            "timing": {"bench": [0, 24]},
+            "allowed_view_format": ["pdf", "image"],
+            "allowed_workbook_format": ["pdf"],
+            "service_account_post": service_account,
+        },
+    }
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        json.dump(config, f)
+
+
+def run_scale(name, tableau, gmail, service_account, parameters):
+    emails, subscribers, attachments = SCALES[name]
+    root = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    os.makedirs(os.path.join(root, "out", "tables"))
+    deliveries = generate_tables(root, tableau, emails, subscribers, attachments)
+    write_config(root, tableau, gmail, service_account, parameters)
+
+    tableau.reset_counters()
+    gmail.reset_counters()
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", CHILD.format(repo=REPO, root=root)],
+                               capture_output=True, text=True, cwd=root)
+    wall = time.perf_counter() - started
+    if completed.returncode != 0:
+        print(completed.stdout[-2000:], completed.stderr[-4000:], file=sys.stderr)
+        raise SystemExit(f"Benchmark run '{name}' failed.")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    print(f"\n== {name}: {emails} emails x {subscribers} subscribers, {attachments} attachments each "
+          f"({deliveries} deliveries)")
+    print(f"sent {gmail.sent} emails in {result['elapsed']:.1f} s ({gmail.sent / result['elapsed']:.1f} emails/s), "
+          f"process {wall:.1f} s, peak RSS {result['max_rss_kb'] / 1024:.0f} MB")
+    print(f"tableau: {tableau.renders} renders ({tableau.bytes_sent / 2 ** 20:.1f} MB), "
+          f"{tableau.rejected} rejected, peak {tableau.peak_in_flight} concurrent; "
+          f"gmail: {gmail.bytes_received / 2 ** 20:.1f} MB raw")
+    print(f"{'phase':<22} {'count':>6} {'total s':>9} {'MB':>8} {'retries':>8}")
+    for phase, (count, total, size, retries) in result["phases"].items():
+        print(f"{phase:<22} {count:>6} {total:>9.2f} {size / 2 ** 20:>8.1f} {retries:>8}")
+
+
+def parse_parameter(value):
+    key, _, raw = value.partition("=")
+    try:
+        return key, json.loads(raw)
+    except ValueError:
+        return key, raw
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scales", nargs="+", choices=SCALES, default=["small", "medium"])
+    parser.add_argument("--render-latency", type=float, default=0.1, help="mean Tableau render latency (s)")
+    parser.add_argument("--send-latency", type=float, default=0.02, help="mean Gmail send latency (s)")
+    parser.add_argument("--pdf-kb", type=int, default=100)
+    parser.add_argument("--image-kb", type=int, default=50)
+    parser.add_argument("--max-renders", type=int, default=None, help="Tableau answers 503 over this concurrency")
+    parser.add_argument("--param", action="append", default=[], type=parse_parameter,
+                        help="Configuration parameter, e.g. download_workers=8")
+    args = parser.parse_args(argv)
+
+    tableau = FakeTableau(latency=args.render_latency, pdf_size=args.pdf_kb * 1024, image_size=args.image_kb * 1024,
+                          max_renders=args.max_renders).start()
+    gmail = FakeGmail(latency=args.send_latency).start()
+    parameters = dict(DEFAULT_PARAMETERS, **dict(args.param))
+    print(f"parameters: {json.dumps(parameters)}")
+    try:
+        service_account = gmail.service_account_info()
+        for name in args.scales:
+            run_scale(name, tableau, gmail, service_account, parameters)
+    finally:
+        tableau.stop()
+        gmail.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import datetime
+
+import tableauserverclient as TSC
+
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class TableauCatalog:
+    """
+    Run-level index of all workbooks and views on the site.
+
+    Workbooks and views are paged through once and indexed by (project, workbook) and
+    (project, workbook, view), so resolving an attachment without LUID is a dict lookup.
+    Usage statistics are not part of the catalog and are fetched only on request.
+
+    The catalog can be serialized with `to_dict` and brought up to date with `refresh`,
+    which only fetches workbooks updated since the last sync.
+    """
+
+    PAGE_SIZE = 1000
+    # server and local clocks are not in sync, overlap incremental windows a bit
+    SYNC_OVERLAP = datetime.timedelta(minutes=10)
+
+    def __init__(self):
+        self.workbooks = {}
+        self.views = {}
+        self.synced_at = None
+        self.full_synced_at = None
+        self._workbook_index = {}
+        self._view_index = {}
+
+    @staticmethod
+    def _workbook_record(workbook):
+        return {
+            "id": workbook.id,
+            "name": workbook.name,
+            "content_url": workbook.content_url,
+            "project_id": workbook.project_id,
+            "project_name": workbook.project_name,
+            "owner_id": workbook.owner_id,
+            "updated_at": workbook.updated_at.isoformat() if workbook.updated_at else None,
+        }
+
+    @staticmethod
+    def _view_record(view, workbook_id=None):
+        return {
+            "id": view.id,
+            "name": view.name,
+            "content_url": view.content_url,
+            "sheet_type": view.sheet_type,
+            "workbook_id": workbook_id or view.workbook_id,
+        }
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def load(self, server):
+        started = self._now()
+        request_options = TSC.RequestOptions(pagesize=self.PAGE_SIZE)
+        self.workbooks = {wb.id: self._workbook_record(wb) for wb in TSC.Pager(server.workbooks, request_options)}
+        self.views = {view.id: self._view_record(view) for view in TSC.Pager(server.views, request_options)}
+        self.synced_at = self.full_synced_at = started.strftime(TIME_FORMAT)
+        self.build_indexes()
+        print(f"Tableau catalog loaded: {len(self.workbooks)} workbooks, {len(self.views)} views.")
+        return self
+
+    def refresh(self, server, existing_workbook_ids):
+        """
+        Incremental sync: fetches workbooks with updatedAt >= last sync (and their views)
+        and drops workbooks which are no longer in `existing_workbook_ids`.
+        """
+        started = self._now()
+        since = datetime.datetime.strptime(self.synced_at, TIME_FORMAT) - self.SYNC_OVERLAP
+        request_options = TSC.RequestOptions(pagesize=self.PAGE_SIZE)
+        request_options.filter.add(TSC.Filter(TSC.RequestOptions.Field.UpdatedAt,
+                                              TSC.RequestOptions.Operator.GreaterThanOrEqual,
+                                              since.strftime(TIME_FORMAT)))
+
+        changed = list(TSC.Pager(server.workbooks, request_options))
+        deleted = set(self.workbooks) - set(existing_workbook_ids)
+        self._drop_workbooks(deleted | {workbook.id for workbook in changed})
+
+        for workbook in changed:
+            server.workbooks.populate_views(workbook)
+            self.workbooks[workbook.id] = self._workbook_record(workbook)
+            for view in workbook.views:
+                self.views[view.id] = self._view_record(view, workbook.id)
+
+        self.synced_at = started.strftime(TIME_FORMAT)
+        self.build_indexes()
+        print(f"Tableau catalog refreshed: {len(changed)} updated, {len(deleted)} deleted, "
+              f"{len(self.workbooks)} workbooks, {len(self.views)} views.")
+        return self
+
+    def _drop_workbooks(self, workbook_ids):
+        if not workbook_ids:
+            return
+        for workbook_id in workbook_ids:
+            self.workbooks.pop(workbook_id, None)
+        self.views = {view_id: view for view_id, view in self.views.items() if view["workbook_id"] not in workbook_ids}
+
+    def to_dict(self):
+        return {
+            "synced_at": self.synced_at,
+            "full_synced_at": self.full_synced_at,
+            "workbooks": list(self.workbooks.values()),
+            "views": list(self.views.values()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        catalog = cls()
+        catalog.synced_at = data["synced_at"]
+        catalog.full_synced_at = data["full_synced_at"]
+        catalog.workbooks = {workbook["id"]: workbook for workbook in data["workbooks"]}
+        catalog.views = {view["id"]: view for view in data["views"]}
+        catalog.build_indexes()
+        return catalog
+
+    def is_stale(self, max_age_days):
+        """True when the last full sync is older than `max_age_days` (project renames etc. are only seen then)."""
+        if not self.full_synced_at:
+            return True
+        full_synced_at = datetime.datetime.strptime(self.full_synced_at, TIME_FORMAT).replace(tzinfo=datetime.timezone.utc)
+        return self._now() - full_synced_at > datetime.timedelta(days=max_age_days)
+
+    def build_indexes(self):
+        self._workbook_index = {}
+        self._view_index = {}
+        for workbook in self.workbooks.values():
+            key = (workbook["project_name"], workbook["name"])
+            self._workbook_index.setdefault(key, []).append(workbook["id"])
+        for view in self.views.values():
+            workbook = self.workbooks.get(view["workbook_id"])
+            if workbook is None:
+                continue
+            key = (workbook["project_name"], workbook["name"], view["name"])
+            self._view_index.setdefault(key, []).append(view["id"])
+
+    def find_workbook(self, project, workbook):
+        """Returns list of LUIDs of workbooks with this name in this project."""
+        return self._workbook_index.get((project, workbook), [])
+
+    def find_view(self, project, workbook, view):
+        """Returns list of LUIDs of views with this name in this project/workbook."""
+        return self._view_index.get((project, workbook, view), [])
+
+    def views_of_workbook(self, workbook_LUID):
+        return [view for view in self.views.values() if view["workbook_id"] == workbook_LUID]
@@ -0,0 +1,72 @@
+import glob
+import json
+import os
+import threading
+
+
+class DeliveryCheckpoint:
+    """
+    Deliveries completed on `date` – per EMAIL_ID the delivery keys (mode, address the message
+    went to and hash of its content, see Driver.delivery_key) that already went out.
+
+    Every send is appended to a local journal right away (one file per day in `journal_directory`,
+    shared by local shards); the state file gets the deliveries under "deliveries" once, in `close`
+    at the end of the run. A rerun on the same day skips these deliveries, so nothing is rendered
+    or sent twice.
+    """
+
+    STATE_KEY = "deliveries"
+
+    def __init__(self, state, date, journal_directory=None):
+        self.state = state
+        self.date = date
+        self.done = {}
+        self._journal = None
+        self._lock = threading.Lock()
+
+        stored = state.get(self.STATE_KEY) or {}
+        for email_id, deliveries in stored.get(date, {}).items():
+            self.done.setdefault(email_id, set()).update(deliveries)
+        if journal_directory:
+            self._open_journal(journal_directory)
+
+    def _open_journal(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"deliveries-{self.date}.jsonl")
+        for old_path in glob.glob(os.path.join(directory, "deliveries-*.jsonl")):
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        email_id, delivery = json.loads(line)
+                    except ValueError:
+                        # last line may be cut off by a crash
+                        continue
+                    self.done.setdefault(email_id, set()).add(delivery)
+        self._journal = open(path, 'a')
+
+    def is_done(self, email_id, delivery):
+        return delivery in self.done.get(email_id, ())
+
+    def __len__(self):
+        return sum(len(deliveries) for deliveries in self.done.values())
+
+    def mark(self, email_id, deliveries):
+        with self._lock:
+            self.done.setdefault(email_id, set()).update(deliveries)
+            if self._journal is not None:
+                self._journal.write("".join(json.dumps([email_id, delivery]) + "\n" for delivery in deliveries))
+                self._journal.flush()
+
+    def close(self):
+        with self._lock:
+            # only the current day is kept, older deliveries can't be skipped anymore
+            self.state.set(self.STATE_KEY, {self.date: {email_id: sorted(deliveries) for email_id, deliveries in self.done.items()}})
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
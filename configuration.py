@@ -6,10 +6,19 @@ import pandas as pd
 import os
 
 from exceptions import UserException
+from state import State
+from sharding import shard_mask, shard_state_name
+from metrics import RunMetrics
+from schedule import EmailSchedule, timing_table
+
+TIMEZONE = pytz.timezone("Europe/Prague")
+# sloupce, které běh z EMAIL_SUBSCRIBERS / EMAIL_ATTACHMENTS opravdu potřebuje
+SUBSCRIBER_COLUMNS = {"GROUP_ID", "EMAIL", "IS_ACTIVE", "MESSAGE_LOADS", "FILTER_PAYLOAD"}
+ATTACHMENT_COLUMNS = {"EMAIL_ID", "LUID", "TABLEAU_OBJECT", "ATTACHMENT_TYPE", "WORKBOOK", "VIEW", "PROJECT", "FILTER_FIELDS"}
 
 
 class Configuration:
-    def __init__(self, root_directory="/data", code_directory="/code"):
+    def __init__(self, root_directory="/data", code_directory="/code", shard_index=None, shard_count=None):
         self.root = root_directory
         self.code_directory = code_directory
 
@@ -23,6 +32,9 @@ class Configuration:
             print(f"❌ Chyba při načítání config.json: {e}", file=sys.stderr)
             sys.exit(1)
 
+        # shard předaný zvenku = lokální proces, každý píše vlastní state a rodič je pak sloučí
+        self.state = State(self.root, shard_state_name(shard_index) if shard_index is not None else "state.json")
+
         self.parameters = config_data.get("parameters", {})
         self.image_params = config_data.get("image_parameters", {})
 
@@ -37,10 +49,72 @@ class Configuration:
         self.gmail_pass = self.parameters.get("#gmail_pass")
         self.run_specific_email = self.parameters.get("run_specific_email", "")
         self.folder_id = self.parameters.get("folder_id", "")
+        # sharding fronty emailů mezi více jobů / procesů
+        self.shard_index = int(shard_index if shard_index is not None else self.parameters.get("shard_index", 0))
+        self.shard_count = int(shard_count if shard_count is not None else self.parameters.get("shard_count", 1))
+        self.shard_by = self.parameters.get("shard_by", "email")
+        self.local_shards = int(self.parameters.get("local_shards", 1))
+        # EMAIL_SUBSCRIBERS / EMAIL_ATTACHMENTS se čtou po blocích tohoto počtu řádků
+        self.input_chunk_rows = int(self.parameters.get("input_chunk_rows", 100000))
+        # name -> ((mtime, klíče fronty), přefiltrovaný frame) – daemon nečte tabulky znovu každé okno
+        self._filtered = {}
+        # odeslané emaily dne (EMAIL_ID, mód, adresa, hash obsahu) – opakovaný běh je přeskočí; každé odeslání se hned
+        # zapíše do deníku v persistentním adresáři, který přežije i pád jobu (out/state.json Keboola uloží jen po
+        # úspěšném běhu, proto bez adresáře deníku nejde zapnout); volitelné, pro run_specific_email se nepoužije
+        self.checkpoint_deliveries = bool(self.parameters.get("checkpoint_deliveries", False))
+        self.checkpoint_dir = self.parameters.get("checkpoint_dir", "") or self.parameters.get("persistent_cache_dir", "")
+        if self.checkpoint_deliveries and not self.checkpoint_dir:
+            raise UserException(
+                "Parameter 'checkpoint_deliveries' needs 'checkpoint_dir' (or 'persistent_cache_dir') on a persistent volume, "
+                "the state file of a failed job is not kept, so deliveries would be lost exactly when a rerun needs them."
+            )
+        self.render_cache_memory_mb = int(self.parameters.get("render_cache_memory_mb", 256))
+        # cache renderů mezi běhy (adresář na persistentním volume), platí do změny workbooku nebo TTL
+        self.persistent_cache_dir = self.parameters.get("persistent_cache_dir", "")
+        # pozor: updated_at workbooku se nemění při refreshi dat (extract, publikovaný data source) – TTL proto
+        # musí být výrazně kratší než nejkratší periodicita (denně), jinak se pošle včerejší render
+        self.persistent_cache_ttl_hours = float(self.parameters.get("persistent_cache_ttl_hours", 4))
+        # maxAge (minuty) pro Tableau – server smí vrátit vlastní nacachovaný render
+        self.render_max_age_min = int(self.parameters.get("render_max_age_min", 0))
+        self.download_workers = int(self.parameters.get("download_workers", 1))
+        # AIMD limit souběžných renderů – roste, dokud p95 latence drží cíl, při 429/503/timeoutu klesá na půl
+        self.adaptive_concurrency = bool(self.parameters.get("adaptive_concurrency", False))
+        self.render_target_latency_s = float(self.parameters.get("render_target_latency_s", 60))
+        self.render_timeout_s = float(self.parameters.get("render_timeout_s", 300))
+        self.render_max_retries = int(self.parameters.get("render_max_retries", 3))
+        self.stream_downloads = bool(self.parameters.get("stream_downloads", False))
+        self.download_memory_mb = int(self.parameters.get("download_memory_mb", 256))
+        self.gmail_max_message_mb = int(self.parameters.get("gmail_max_message_mb", 25))
+        # "bcc" – odběratelé se shodnou zprávou dostanou jeden společný email
+        self.fanout_mode = self.parameters.get("fanout_mode", "")
+        self.fanout_max_recipients = int(self.parameters.get("fanout_max_recipients", 100))
+        # PAT session na Tableau Serveru vyprší po 240 min nečinnosti, obnovujeme dřív
+        self.tableau_token_ttl_min = int(self.parameters.get("tableau_token_ttl_min", 120))
+        # katalog workbooků se mezi běhy drží ve state, jednou za čas se načte celý znovu
+        self.catalog_full_refresh_days = int(self.parameters.get("catalog_full_refresh_days", 7))
+        # jiný endpoint Gmail API (lokální server benchmarků), prázdné = Google
+        self.gmail_api_endpoint = self.parameters.get("gmail_api_endpoint", "")
+        # Gmail API: messages.send stojí 100 z 250 quota units / s na uživatele
+        self.gmail_send_workers = int(self.parameters.get("gmail_send_workers", 1))
+        self.gmail_send_rate = float(self.parameters.get("gmail_send_rate", 2.5))
+        self.gmail_send_burst = int(self.parameters.get("gmail_send_burst", 5))
+        self.gmail_max_retries = int(self.parameters.get("gmail_max_retries", 5))
+        # "batch" – posílání přes Gmail batch API po gmail_batch_size zprávách
+        self.gmail_send_mode = self.parameters.get("gmail_send_mode", "single")
+        self.gmail_batch_size = int(self.parameters.get("gmail_batch_size", 50))
+        # "pipeline" – stahování, skládání zpráv a odesílání běží souběžně (asyncio fronty)
+        self.execution_engine = self.parameters.get("execution_engine", "batch")
+        self.pipeline_render_workers = int(self.parameters.get("pipeline_render_workers", max(self.download_workers, 4)))
+        self.pipeline_assemble_workers = int(self.parameters.get("pipeline_assemble_workers", 2))
+        self.pipeline_send_workers = int(self.parameters.get("pipeline_send_workers", max(self.gmail_send_workers, 2)))
+        self.pipeline_queue_size = int(self.parameters.get("pipeline_queue_size", 10))
+        # časy jednotlivých fází běhu jako výstupní tabulka run_metrics (inkrementálně, pro trendy)
+        self.export_metrics = bool(self.parameters.get("export_metrics", False))
 
         # Z image_parameters
         # Z image_parameters
         self.timing_rule = self.image_params.get("timing", {})
+        self.timing_table = timing_table(self.timing_rule)
         self.gmail_port = self.image_params.get("gmail_port", 587)
         self.imap_port = self.image_params.get("imap_port", 993)
         self.allowed_workbook_format = self.image_params.get("allowed_workbook_format", [])
@@ -63,23 +137,76 @@ class Configuration:
                     "name": "table2",
                     "columns": ["id", "col1", "col2", "col3"],
                     "primary_keys": ["id"]
+                },
+                {
+                    "name": "run_metrics",
+                    "columns": RunMetrics.COLUMNS,
+                    "primary_keys": ["RUN_ID", "SHARD", "SEQ"]
                 }
             ]
         }
 
+    def write_table_manifest(self, table_path, columns=None, primary_key=None, incremental=False):
+        """Keboola manifest of an output table – a sliced table (folder of parts) needs the columns listed."""
+        manifest = {"incremental": incremental}
+        if columns is not None:
+            manifest["columns"] = columns
+        if primary_key is not None:
+            manifest["primary_key"] = primary_key
+        with open(f"{table_path}.manifest", 'w') as f:
+            json.dump(manifest, f)
+
     def get_input_data(self):
+        # odběratele a přílohy načítáme až pro emaily ve frontě (filter_subscribers, identify_attachments)
         try:
-            self.email_attachments = pd.read_csv(f"{self.root}/in/tables/EMAIL_ATTACHMENTS.csv", dtype=str)
+            self.input_mtimes = self.read_input_mtimes()
             self.emails = pd.read_csv(f"{self.root}/in/tables/EMAILS.csv", dtype=str)
-            self.email_subscribers = pd.read_csv(f"{self.root}/in/tables/EMAIL_SUBSCRIBERS.csv", dtype=str)
         except Exception as e:
             print(f'Chyba při načítání vstupních dat: {e}')
             sys.exit()
+        self.schedule = None
+
+    def read_filtered(self, name, columns, keys, row_filter):
+        """
+        Streams an input table in chunks, keeps only `columns` and rows where `row_filter(chunk)` holds.
+        The result is reused until the table changes on disk (input_mtimes) or another set of `keys`
+        (GROUP_ID / EMAIL_ID of the queue) is filtered, callers must not modify it.
+        """
+        version = (self.input_mtimes.get(name), frozenset(keys))
+        cached = self._filtered.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        try:
+            chunks = pd.read_csv(f"{self.root}/in/tables/{name}", dtype=str, usecols=lambda column: column in columns,
+                                 chunksize=self.input_chunk_rows)
+            filtered = pd.concat([chunk.loc[row_filter(chunk)] for chunk in chunks])
+        except Exception as e:
+            # čte se až pro frontu (i v daemonu) – chyba musí být vidět, ne tiché sys.exit() s kódem 0
+            raise UserException(f'Chyba při načítání vstupních dat {name}: {e}') from e
+        self._filtered[name] = (version, filtered)
+        return filtered
+
+    def read_input_mtimes(self):
+        return {name: os.stat(f"{self.root}/in/tables/{name}").st_mtime_ns
+                for name in ("EMAIL_ATTACHMENTS.csv", "EMAILS.csv", "EMAIL_SUBSCRIBERS.csv")}
+
+    def input_changed(self):
+        """True when some input table changed on disk since get_input_data."""
+        try:
+            return self.read_input_mtimes() != self.input_mtimes
+        except OSError:
+            # soubor se zrovna přepisuje, načteme ho příště
+            return False
 
     def filter_subscribers(self):
-        self.active_subscribers = self.email_subscribers.loc[self.email_subscribers.IS_ACTIVE != 'disabled']
+        groups = set(self.email_queue.GROUP_ID)
+        self.active_subscribers = self.read_filtered(
+            "EMAIL_SUBSCRIBERS.csv", SUBSCRIBER_COLUMNS, groups,
+            lambda chunk: chunk.GROUP_ID.isin(groups) & (chunk.IS_ACTIVE != 'disabled')
+        )
 
-    def filter_emails(self):
+    def filter_emails(self, run_time=None):
+        self.run_time = run_time = run_time or datetime.datetime.now(TIMEZONE)
         if self.run_specific_email:
             self.email_queue = self.emails.loc[
                 (self.emails.MODE != 'deprecated') &
@@ -88,40 +215,34 @@ class Configuration:
             ]
             print(f"Running only specific email: {self.run_specific_email}")
         else:
-            run_time = datetime.datetime.now(pytz.timezone("Europe/Prague"))
-
-            the_timing = ""
-            for name, hours in self.timing_rule.items():
-                if hours[0] < hours[1]:
-                    if hours[0] <= run_time.hour < hours[1]:
-                        the_timing = name
-                elif run_time.hour >= hours[0] or run_time.hour < hours[1]:
-                    the_timing = name
-
+            the_timing = self.timing_table[run_time.hour]
             the_weekly_periodicity = run_time.weekday() + 1
             the_monthly_periodicity = run_time.day
 
             print(f"Running emails – timing: {the_timing}, monthly: {the_monthly_periodicity}, weekly: {the_weekly_periodicity}")
 
+            # index emailů podle slotů se staví jednou na načtená data
+            if self.schedule is None:
+                self.schedule = EmailSchedule(self.emails)
             self.email_queue = self.emails.loc[
-                (self.emails.MODE != 'deprecated') &
-                (
-                    ((self.emails.PERIODICITY == 'weekly') & (self.emails.PERIODICITY_SPECIFICATION == str(the_weekly_periodicity))) |
-                    ((self.emails.PERIODICITY == 'monthly') & (self.emails.PERIODICITY_SPECIFICATION == str(the_monthly_periodicity))) |
-                    (self.emails.PERIODICITY == 'daily')
-                ) &
-                (self.emails.TIMING == the_timing)
+                self.schedule.lookup(the_timing, the_weekly_periodicity, the_monthly_periodicity)
+            ]
+
+        if self.shard_count > 1:
+            self.email_queue = self.email_queue.loc[
+                shard_mask(self.email_queue, self.shard_index, self.shard_count, self.shard_by)
             ]
+            print(f"Shard {self.shard_index + 1}/{self.shard_count} by {self.shard_by}: {len(self.email_queue)} emails.")
 
     def identify_attachments(self, tbl):
-        tmp_attachments = self.email_attachments[self.email_attachments.EMAIL_ID.isin(self.email_queue.EMAIL_ID)]
+        email_ids = set(self.email_queue.EMAIL_ID)
+        tmp_attachments = self.read_filtered("EMAIL_ATTACHMENTS.csv", ATTACHMENT_COLUMNS, email_ids,
+                                             lambda chunk: chunk.EMAIL_ID.isin(email_ids))
         self.current_attachments = tmp_attachments.copy()
 
         for i, row in tmp_attachments.iterrows():
             if pd.isna(row.LUID):
-                workbook_LUID = tbl.workbooks.loc[
-                    (tbl.workbooks[1] == row.WORKBOOK) & (tbl.workbooks[8] == row.PROJECT)
-                ][0].values
+                workbook_LUID = tbl.find_workbook(row.PROJECT, row.WORKBOOK)
 
                 if len(workbook_LUID) != 1:
                     raise Exception(f"Ambiguous Tableau workbook: {row.PROJECT}/{row.WORKBOOK} – {row.EMAIL_ID}")
@@ -130,19 +251,23 @@ class Configuration:
                 if row.TABLEAU_OBJECT == "workbook":
                     self.current_attachments.loc[i, "LUID"] = workbook_LUID
                 elif row.TABLEAU_OBJECT == "view":
-                    views = tbl.get_views_of_workbook(workbook_LUID)
-                    view_LUID = views.loc[views[3] == row.VIEW][2].values
+                    view_LUID = tbl.find_view(row.PROJECT, row.WORKBOOK, row.VIEW)
                     if len(view_LUID) != 1:
                         raise Exception(f"Ambiguous Tableau view: {row.PROJECT}/{row.WORKBOOK}/{row.VIEW} – {row.EMAIL_ID}")
                     self.current_attachments.loc[i, "LUID"] = view_LUID[0]
-            else:
-                if row.TABLEAU_OBJECT == "workbook":
-                    try:
-                        tbl.auth_TSC().workbooks.get_by_id(row.LUID)
-                    except KeyError:
-                        raise UserException(f"Workbook {row.LUID} not found ({row.EMAIL_ID})")
-                elif row.TABLEAU_OBJECT == "view":
-                    try:
-                        tbl.auth_TSC().views.get_by_id(row.LUID)
-                    except KeyError:
-                        raise UserException(f"View {row.LUID} not found ({row.EMAIL_ID})")
+
+        self.validate_luids(tbl, tmp_attachments[tmp_attachments.LUID.notna()])
+
+    def validate_luids(self, tbl, attachments):
+        """Checks all pre-set LUIDs with one id listing per object type and reports every missing one."""
+        missing = []
+        for tableau_object, object_class in (("workbook", "workbooks"), ("view", "views")):
+            rows = attachments[attachments.TABLEAU_OBJECT == tableau_object]
+            if rows.empty:
+                continue
+            existing = set(tbl.existing_luids(object_class))
+            for row in rows[~rows.LUID.isin(existing)].itertuples():
+                missing.append(f"{tableau_object.capitalize()} {row.LUID} not found ({row.EMAIL_ID})")
+
+        if missing:
+            raise UserException("\n".join(missing))
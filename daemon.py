@@ -0,0 +1,78 @@
+##### daemon.py
+
+print("🚀 Starting Tableau Subscriptions daemon...")
+
+
+import datetime
+import sys
+import time
+import traceback
+from configuration import TIMEZONE
+from driver import Driver
+from metrics import RunMetrics
+from exceptions import UserException
+
+
+class Daemon:
+    """
+    Resident scheduler – one long-running process instead of an hourly container.
+
+    Configuration, the email schedule, the Tableau catalog and Tableau / Gmail sessions stay loaded
+    between timing windows. Input tables are read again only when they change on disk – subscribers
+    and attachments of the queue also when the queue asks for other groups / emails. At every
+    full hour (Europe/Prague) the emails due in that hour are sent, the same as one run of main.py.
+    """
+
+    def __init__(self, root_directory="/data", code_directory="/code/"):
+        # config and inputs only, every window (the first one too) is prepared in run_window
+        self.driver = Driver(root_directory, code_directory, prepare=False)
+        if self.driver.cfg.run_specific_email:
+            raise UserException("Parameter 'run_specific_email' runs a single email once, use main.py for it.")
+
+    def run_forever(self):
+        run_time = datetime.datetime.now(TIMEZONE)
+        while True:
+            self.run_window(lambda: self.tick(run_time))
+            run_time = self.wait_for_next_window()
+
+    def run_window(self, func):
+        try:
+            func()
+        except (Exception, SystemExit) as err:
+            # one failed window must not stop the scheduler, the next one runs as usual
+            # (SystemExit – get_input_data exits when a reloaded input table can't be read)
+            print(f"Run failed: {err}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+
+    def tick(self, run_time):
+        driver = self.driver
+        driver.metrics = RunMetrics(run_id=run_time.strftime("%Y%m%dT%H%M"), shard_index=driver.cfg.shard_index)
+        if driver.cfg.input_changed():
+            with driver.metrics.phase("input_data"):
+                driver.cfg.get_input_data()
+            print(">>> INPUT DATA RELOADED")
+        driver.prepare(run_time)
+        return driver.run()
+
+    @staticmethod
+    def wait_for_next_window():
+        now = datetime.datetime.now(TIMEZONE)
+        next_hour = TIMEZONE.normalize(now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1))
+        print(f"Next timing window at {next_hour.isoformat()}")
+        while now < next_hour:
+            time.sleep(min((next_hour - now).total_seconds(), 60))
+            now = datetime.datetime.now(TIMEZONE)
+        return now
+
+
+exit_codes = [1, 2, 3]
+if __name__ == "__main__":
+    try:
+        Daemon('/data', '/code/').run_forever()
+    except UserException as err:
+        print('%s' % err, file=sys.stderr)
+        sys.exit(exit_codes[0])
+    except Exception as err:
+        print('%s' % err, file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(exit_codes[0])
@@ -0,0 +1,165 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+
+from exceptions import UserException
+from render_cache import RenderCache
+
+
+def encoded_size(size):
+    """Size of `size` bytes after base64 encoding into the MIME message."""
+    return (size + 2) // 3 * 4
+
+
+class MemoryBudget:
+    """
+    Byte budget of streamed attachments, from the download until the message carrying them is sent.
+
+    Downloads reserve their bytes before they read them. While the budget is full and messages
+    holding part of it are being sent, a download waits – those sends release their bytes. Bytes of
+    messages not handed to Gmail yet are not waited for, the waiting download may be what they need
+    to get sent (the batch engine sends a batch only after all of it downloads); the batch engine
+    instead prefetches only as many jobs as `fits` into the budget.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.sending = 0
+        # largest download so far – estimate of what the next one needs
+        self.largest = 0
+        self._held = {}
+        self._cond = threading.Condition()
+
+    def reserve(self, size):
+        with self._cond:
+            if size > self.limit:
+                raise UserException(
+                    f"Attachment of {size} B doesn't fit into the download memory budget of {self.limit} B, raise download_memory_mb."
+                )
+            while self.used + size > self.limit and self.sending:
+                self._cond.wait()
+            self.used += size
+
+    def fits(self, size):
+        """How many downloads of `size` bytes fit into the free part of the budget, at least one."""
+        with self._cond:
+            return max((self.limit - self.used) // size, 1) if size else None
+
+    def release(self, size):
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+    def hold(self, key, size):
+        """Keeps the reservation of a finished download of `key` until a message takes it."""
+        with self._cond:
+            self._held[key] = self._held.get(key, 0) + size
+            self.largest = max(self.largest, size)
+
+    def take(self, keys):
+        """Reservations of downloads `keys` for one message, the sender releases them once it is sent."""
+        with self._cond:
+            return sum(self._held.pop(key, 0) for key in set(keys))
+
+    def send_started(self, size):
+        with self._cond:
+            self.sending += size
+
+    def send_finished(self, size):
+        with self._cond:
+            self.sending -= size
+            self.used -= size
+            self._cond.notify_all()
+
+
+def read_streamed(resp, budget, max_message_bytes, chunk_size=1024 * 1024):
+    """
+    Reads a streamed response chunk by chunk into one buffer reserved in `budget` first.
+
+    With Content-Length the whole announced size is reserved before the buffer is allocated once,
+    otherwise every chunk is reserved before it is stored. On success the reservation (len of the
+    result) stays with the caller, see MemoryBudget.hold.
+    Fails as soon as the attachment can't fit into a Gmail message of `max_message_bytes`.
+    """
+    def check_size(size):
+        if encoded_size(size) > max_message_bytes:
+            raise UserException(
+                f"Attachment {resp.url} has {size} B and exceeds Gmail message size limit of {max_message_bytes} B."
+            )
+
+    length = resp.headers.get("Content-Length")
+    if length is not None:
+        check_size(int(length))
+
+    size = 0
+    reserved = 0
+    try:
+        announced = int(length) if length is not None else 0
+        budget.reserve(announced)
+        reserved = announced
+        content = bytearray(announced)
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            check_size(size + len(chunk))
+            if size + len(chunk) > reserved:
+                # body longer than announced (or no Content-Length)
+                if size + len(chunk) > budget.limit:
+                    raise UserException(
+                        f"Attachment {resp.url} has more than {budget.limit} B and doesn't fit into the download memory budget, raise download_memory_mb."
+                    )
+                budget.reserve(size + len(chunk) - reserved)
+                reserved = size + len(chunk)
+            content[size:size + len(chunk)] = chunk
+            size += len(chunk)
+        del content[size:]
+        if reserved > size:
+            budget.release(reserved - size)
+            reserved = size
+    except BaseException:
+        budget.release(reserved)
+        raise
+    finally:
+        resp.close()
+    return content
+
+
+class AttachmentDownloader:
+    """
+    Downloads a list of attachments with bounded parallelism.
+
+    `downloads` are tuples (url, url_params, *extra), `fetch(url, url_params, *extra)` is called for
+    every distinct (url, url_params) pair and results are returned in the order of the input list. The first failing download aborts the whole batch.
+    With `workers <= 1` the downloads run one after another in the calling thread.
+    """
+
+    def __init__(self, fetch, workers=1):
+        self.fetch = fetch
+        self.workers = max(int(workers), 1)
+
+    @property
+    def batch_size(self):
+        # how many subscribers are prefetched together, keeps all workers busy
+        return 1 if self.workers == 1 else self.workers * 2
+
+    def download_all(self, downloads):
+        if self.workers == 1:
+            return [self.fetch(*download) for download in downloads]
+
+        keys = [RenderCache.make_key(download[0], download[1]) for download in downloads]
+        unique = {}
+        for key, download in zip(keys, downloads):
+            unique.setdefault(key, download)
+
+        executor = ThreadPoolExecutor(max_workers=min(self.workers, len(unique)) or 1)
+        try:
+            futures = {executor.submit(self.fetch, *download): key for key, download in unique.items()}
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in done:
+                if future.exception() is not None:
+                    for pending in not_done:
+                        pending.cancel()
+                    raise future.exception()
+            results = {key: future.result() for future, key in futures.items()}
+        finally:
+            executor.shutdown(wait=True)
+
+        return [results[key] for key in keys]
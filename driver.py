@@ -1,130 +1,440 @@
-import pandas as pd
+import hashlib
 import json
-import re
+import threading
+import time
 import unidecode
-import os
-import glob
-from PyPDF2 import PdfMerger
+import io
+from concurrent.futures import Future
 
 from configuration import Configuration
-from Tableau_driver import Tableau
-from gmail import Gmail
+from render_cache import RenderCache
+from persistent_cache import PersistentRenderCache
+from checkpoint import DeliveryCheckpoint
+from downloader import AttachmentDownloader, MemoryBudget, encoded_size, read_streamed
+from exceptions import UserException
+from sender import SendPipeline
+from plan import SendPlan
+from templates import compile_template, decode_json
+from pipeline import StagedPipeline
+from ratelimit import AdaptiveLimiter, backoff_delay, retry_after_seconds
+from metrics import RunMetrics
+from writer import Writer
 
 
 class Driver:
 
-    def __init__(self, root_directory, code_directory):
+    def __init__(self, root_directory, code_directory, shard_index=None, shard_count=None, prepare=True):
         print(">>> DRIVER INIT STARTED")
-        self.cfg = Configuration(root_directory, code_directory)
+        self.root_directory = root_directory
+        self.code_directory = code_directory
+        self.tableau = None
+        self.gmail = None
+        self.persistent_cache = None
+        self.metrics = RunMetrics(shard_index=shard_index or 0)
+        with self.metrics.phase("config"):
+            self.cfg = Configuration(root_directory, code_directory, shard_index=shard_index, shard_count=shard_count)
         print(">>> CONFIGURATION LOADED")
 
-        self.cfg.get_input_data()
+        with self.metrics.phase("input_data"):
+            self.cfg.get_input_data()
         print(">>> INPUT DATA LOADED")
 
-        self.cfg.filter_emails()
+        # the daemon prepares every window itself
+        if prepare:
+            self.prepare()
+
+    def prepare(self, run_time=None):
+        """Filters the queue for `run_time` (now by default) and sets up a run of it. Open Tableau and Gmail clients are reused."""
+        with self.metrics.phase("filter_emails"):
+            self.cfg.filter_emails(run_time)
         print(">>> EMAILS FILTERED")
 
-        self.cfg.filter_subscribers()
+        self.idle = self.cfg.email_queue.empty
+        if self.idle:
+            print(">>> NO EMAILS IN QUEUE, SKIPPING TABLEAU AND GMAIL LOGIN")
+            # carry the stored state (Tableau catalog) over to the next run
+            self.cfg.state.write()
+            self.export_metrics()
+            return
+
+        with self.metrics.phase("filter_subscribers"):
+            self.cfg.filter_subscribers()
         print(">>> SUBSCRIBERS FILTERED")
 
-        self.tableau = Tableau(self.cfg)
-        print(">>> TABLEAU OBJECT CREATED")
+        if self.tableau is None:
+            # heavy clients (tableauserverclient, googleapiclient, requests) are imported only when there is work to do
+            from Tableau_driver import Tableau
+            self.tableau = Tableau(self.cfg, pool_size=max(self.cfg.download_workers, self.cfg.pipeline_render_workers),
+                                   metrics=self.metrics)
+            print(">>> TABLEAU OBJECT CREATED")
+        else:
+            self.tableau.metrics = self.metrics
+            # catalog is brought up to date (incrementally) on its next use
+            self.tableau.invalidate_catalog()
 
-        self.cfg.identify_attachments(self.tableau)
+        with self.metrics.phase("identify_attachments"):
+            self.cfg.identify_attachments(self.tableau)
         print(">>> ATTACHMENTS IDENTIFIED")
 
         self.s = self.tableau.login()
         print(">>> TABLEAU LOGIN SUCCESS")
 
-        self.gmail = Gmail(root_directory, code_directory)
-        self.gmail.gmail_login()
-        print(">>> GMAIL LOGIN SUCCESS")
+        if self.gmail is None:
+            from gmail import Gmail
+            self.gmail = Gmail(self.root_directory, self.code_directory)
+            with self.metrics.phase("gmail_login"):
+                self.gmail.gmail_login()
+            print(">>> GMAIL LOGIN SUCCESS")
+
+        self.checkpoint = None
+        if self.cfg.checkpoint_deliveries and not self.cfg.run_specific_email:
+            # run_specific_email is a deliberate resend, it must not be skipped as already delivered
+            self.checkpoint = DeliveryCheckpoint(self.cfg.state, self.cfg.run_time.date().isoformat(),
+                                                 journal_directory=self.cfg.checkpoint_dir)
+        self.render_cache = RenderCache(memory_budget=self.cfg.render_cache_memory_mb * 1024 * 1024)
+        # render key -> Future of the download in progress, parallel workers share one request
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        if self.persistent_cache is None and self.cfg.persistent_cache_dir:
+            self.persistent_cache = PersistentRenderCache(self.cfg.persistent_cache_dir, ttl_hours=self.cfg.persistent_cache_ttl_hours)
+        if self.persistent_cache is not None:
+            # render_version needs the catalog – resolve it here, not lazily in the download workers
+            self.tableau.catalog
+        render_workers = max(self.cfg.download_workers, self.cfg.pipeline_render_workers if self.cfg.execution_engine == "pipeline" else 1)
+        if self.cfg.adaptive_concurrency:
+            self.render_limiter = AdaptiveLimiter(initial=min(2, render_workers), maximum=render_workers,
+                                                  target_latency=self.cfg.render_target_latency_s)
+        else:
+            self.render_limiter = AdaptiveLimiter(initial=render_workers, minimum=render_workers, maximum=render_workers)
+        self.download_budget = MemoryBudget(self.cfg.download_memory_mb * 1024 * 1024)
+        self.downloader = AttachmentDownloader(self.download_attachment, workers=self.cfg.download_workers)
+        self.sender = SendPipeline(self.gmail, workers=self.cfg.gmail_send_workers,
+                                   rate=self.cfg.gmail_send_rate, burst=self.cfg.gmail_send_burst,
+                                   batch_size=self.cfg.gmail_batch_size if self.cfg.gmail_send_mode == "batch" else 1,
+                                   metrics=self.metrics, budget=self.download_budget)
         print(">>> DRIVER INIT FINISHED")
 
     def run(self):
-        for email_index, email in self.cfg.email_queue.iterrows():
-            print(f"Processing: {email.EMAIL_ID}.")
-            temp_active_subscribers = self.cfg.active_subscribers.loc[
-                self.cfg.active_subscribers.GROUP_ID == email.GROUP_ID
-            ]
-            temp_current_attachments = self.cfg.current_attachments.loc[
-                self.cfg.current_attachments.EMAIL_ID == email.EMAIL_ID
-            ]
-
-            for subsc_index, subsc in temp_active_subscribers.iterrows():
-                txt = self.compile_msg(email.MESSAGE, subsc)
-                subject = self.compile_msg(email.SUBJECT, subsc)
-                to = self.set_recepients(email, subsc)
-                msg = self.gmail.construct_message(
-                    to=to,
-                    subject=subject,
-                    text=txt,
-                )
+        if self.idle:
+            return 0
+        try:
+            with self.metrics.phase("run"):
+                result = self._run()
+        except Exception:
+            self.sender.close(cancel=True)
+            raise
+        else:
+            self.sender.close()
+            return result
+        finally:
+            print(self.render_cache.report())
+            print(self.render_limiter.report())
+            print(self.sender.report())
+            self.render_cache.close()
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+            if self.persistent_cache is not None:
+                print(self.persistent_cache.report())
+                self.persistent_cache.prune()
+            self.cfg.state.write()
+            self.export_metrics()
+
+    def export_metrics(self):
+        print(self.metrics.summary())
+        if self.cfg.export_metrics:
+            prefix = f"{self.metrics.run_id}_shard{self.cfg.shard_index}_" if self.cfg.shard_count > 1 else f"{self.metrics.run_id}_"
+            Writer(self.cfg, "run_metrics", incremental=True, part_prefix=prefix).export_to_csv(self.metrics.to_frame())
+
+    def _run(self):
+        with self.metrics.phase("plan"):
+            self.plan = SendPlan.build(self.cfg.email_queue, self.cfg.active_subscribers, self.cfg.current_attachments)
+            if self.checkpoint is not None and len(self.checkpoint):
+                planned = len(self.plan)
+                self.plan = self.plan.skip(lambda job: self.checkpoint.is_done(
+                    job.email.EMAIL_ID, self.delivery_key(job, self.set_recepients(job.email, job.subscriber), job.subscriber.EMAIL)))
+                print(f"Skipping {planned - len(self.plan)} deliveries already sent today.")
+            if self.cfg.fanout_mode == "bcc":
+                self.plan = self.plan.fan_out(self.fanout_key, self.cfg.fanout_max_recipients)
+        print(self.plan.summary())
+
+        if self.cfg.execution_engine == "pipeline":
+            self._run_pipeline(self.plan.jobs)
+        else:
+            self._run_batches(self.plan.jobs)
 
-                pdf_merger = PdfMerger()
-
-                if temp_current_attachments.empty:
-                    print(f"""No attachment for email with EMAIL_ID: {email.EMAIL_ID}, please check input tables""")
-                    return
-
-                for attach_index, attach in temp_current_attachments.iterrows():
-                    url_params = self.compile_params(attach, subsc)
-                    url = self.construct_attachment_url(attach)
-                    attachment_name = self.attachment_name(attach, url_params)
-                    resp = self.s.get(url, params=url_params)
-                    if resp.status_code != 200:
-                        raise Exception(
-                            f"Download of attachment fails. url: {url}, url_params: {url_params} with server response: {resp.text}"
-                        )
-                    else:
-                        print("Successfully called: " + resp.url)
-
-                    if (email.MERGE_ATTACHMENTS == 'merge') and (attach.ATTACHMENT_TYPE == 'pdf'):
-                        tmp_path = f'{self.cfg.root}/out/tmp_{attach_index}.pdf'
-                        with open(tmp_path, 'wb') as f:
-                            f.write(resp.content)
-                        try:
-                            pdf_merger.append(tmp_path)
-                        except Exception as e:
-                            print(f"\u274c Error appending PDF {tmp_path}: {e}")
-                    else:
-                        msg = self.gmail.attach_to_message(msg, resp.content, attachment_name, attach.ATTACHMENT_TYPE)
-
-                if email.MERGE_ATTACHMENTS == 'merge':
-                    if os.path.exists(f'{self.cfg.root}/out/report.pdf'):
-                        os.remove(f'{self.cfg.root}/out/report.pdf')
-                    with open(f'{self.cfg.root}/out/report.pdf', 'wb') as output_file:
-                        pdf_merger.write(output_file)
-                    pdf_merger.close()
-
-                    # cleanup temporary PDF parts
-                    for f in glob.glob(f"{self.cfg.root}/out/tmp_*.pdf"):
-                        os.remove(f)
-
-                    with open(f'{self.cfg.root}/out/report.pdf', 'rb') as f:
-                        msg = self.gmail.attach_to_message(msg, f.read(), "report.pdf", "pdf")
-
-                # always send email now
-                self.gmail.send_email(to, msg.as_string())
-                print(f"Sent email: {email.EMAIL_ID} in {email.MODE} mode on {to}")
-
-        return 0
+        return None if self.plan.stopped_at else 0
 
-    def compile_msg(self, text, subsc):
-        tags_to_replace = re.findall("{[^\s]+}", text)
-        tags_to_search = [re.search("[^{}]+", tag).group(0) for tag in tags_to_replace]
+    def _run_pipeline(self, jobs):
+        """Downloads, message assembly and sends overlap, each stage with its own concurrency."""
+        if self.sender.batch_size > 1:
+            # gmail_send_mode "batch" – one worker collects messages into Gmail batch requests,
+            # the sender sends them with its own workers and flushes the rest in close()
+            send_stage = ("send", lambda item: self.sender.submit(*item), 1)
+        else:
+            send_stage = ("send", lambda item: self.sender.send(*item), self.cfg.pipeline_send_workers)
+        pipeline = StagedPipeline([
+            ("render", lambda job: (job, self.render_job(job)), self.cfg.pipeline_render_workers),
+            ("assemble", lambda item: self.assemble_message(*item), self.cfg.pipeline_assemble_workers),
+            send_stage,
+        ], queue_size=self.cfg.pipeline_queue_size)
+        pipeline.run(jobs)
+
+    def render_job(self, job):
+        return [self.download_attachment(self.construct_attachment_url(attach), self.compile_params(attach, job.subscriber), attach)
+                for attach in job.attachments]
+
+    def _run_batches(self, jobs):
+        current_email = None
+        batch_start = 0
+
+        while batch_start < len(jobs):
+            batch = jobs[batch_start:batch_start + self.prefetch_size(jobs[batch_start])]
+            batch_start += len(batch)
+            downloads = []
+            for job in batch:
+                for attach in job.attachments:
+                    downloads.append((self.construct_attachment_url(attach), self.compile_params(attach, job.subscriber), attach))
+
+            contents = iter(self.downloader.download_all(downloads))
+            for job in batch:
+                if job.email.EMAIL_ID != current_email:
+                    current_email = job.email.EMAIL_ID
+                    print(f"Processing: {current_email}.")
+                self.sender.submit(*self.assemble_message(job, [next(contents) for _ in job.attachments]))
+
+    def prefetch_size(self, job):
+        """
+        Jobs downloaded together by the batch engine – enough to keep all download workers busy.
+        With stream_downloads no more than the download budget holds, the batch is sent only after it
+        downloads, so its downloads can't wait for the budget; sized by the largest attachment so far.
+        """
+        batch_size = self.downloader.batch_size
+        if self.cfg.stream_downloads and batch_size > 1:
+            largest = self.download_budget.largest
+            # until a size is known, one job at a time
+            batch_size = min(batch_size, self.download_budget.fits(largest * len(job.attachments)) if largest else 1)
+        return batch_size
+
+    def assemble_message(self, job, contents):
+        """Builds the MIME message of a job, returns (to, msg, on_sent, reserved) for the sender."""
+        email, subsc = job.email, job.subscriber
+        txt = self.compile_msg(email.MESSAGE, subsc)
+        subject = self.compile_msg(email.SUBJECT, subsc)
+        to = self.set_recepients(email, subsc)
+        bcc = None
+        if job.recipients:
+            # one message for all subscribers with identical content, they only see the sender
+            to, bcc = self.cfg.gmail_address, ",".join(job.recipients)
+        msg = self.gmail.construct_message(
+            to=to,
+            subject=subject,
+            text=txt,
+            bcc=bcc,
+        )
+
+        pdf_parts = []
+        keys = []
+
+        for attach, content in zip(job.attachments, contents):
+            url_params = self.compile_params(attach, subsc)
+            keys.append(self.render_cache.make_key(self.construct_attachment_url(attach), url_params))
+            attachment_name = self.attachment_name(attach, url_params)
+
+            if (email.MERGE_ATTACHMENTS == 'merge') and (attach.ATTACHMENT_TYPE == 'pdf'):
+                pdf_parts.append((attach.Index, content))
+            else:
+                msg = self.gmail.attach_to_message(msg, content, attachment_name, attach.ATTACHMENT_TYPE)
+
+        if email.MERGE_ATTACHMENTS == 'merge':
+            msg = self.gmail.attach_to_message(msg, self.merge_pdfs(pdf_parts), "report.pdf", "pdf")
+
+        recipients = f"{len(job.recipients)} recipients (bcc)" if job.recipients else to
+
+        def on_sent():
+            print(f"Sent email: {email.EMAIL_ID} in {email.MODE} mode on {recipients}")
+            if self.checkpoint is not None:
+                if job.recipients:
+                    deliveries = [self.delivery_key(job, address, address) for address in job.recipients]
+                else:
+                    deliveries = [self.delivery_key(job, to, subsc.EMAIL)]
+                self.checkpoint.mark(email.EMAIL_ID, deliveries)
+
+        # streamed downloads of this message stay in the download budget until it is sent
+        return to, msg, on_sent, self.download_budget.take(keys)
+
+    def merge_pdfs(self, parts):
+        """Merges PDF parts in memory – the merged report goes into the message as bytes anyway."""
+        from PyPDF2 import PdfMerger
+
+        with self.metrics.phase("merge", f"{len(parts)} parts") as row:
+            pdf_merger = PdfMerger()
+            for attach_index, content in parts:
+                try:
+                    pdf_merger.append(io.BytesIO(content))
+                except Exception as e:
+                    print(f"\u274c Error appending PDF part {attach_index}: {e}")
+
+            output_file = io.BytesIO()
+            pdf_merger.write(output_file)
+            pdf_merger.close()
+            merged = output_file.getvalue()
+            row["bytes"] = len(merged)
+            return merged
+
+    def download_attachment(self, url, url_params, attach=None):
+        with self.metrics.phase("download", url) as row:
+            content = self._download_attachment(url, url_params, attach, row)
+            row["bytes"] = len(content)
+            return content
+
+    def _download_attachment(self, url, url_params, attach, row):
+        key = self.render_cache.make_key(url, url_params)
+        content = self.render_cache.get(key)
+        if content is not None:
+            print(f"Render cache hit: {url} {url_params}")
+            row["status"] = "render_cache"
+            return content
+
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+        if not owner:
+            print(f"Waiting for download in progress: {url} {url_params}")
+            row["status"] = "in_flight"
+            return future.result()
+
+        try:
+            # the previous download of the key may have finished between the cache check and the lock
+            content = self.render_cache.get(key)
+            if content is None:
+                content = self._fetch_attachment(key, url, url_params, attach, row)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(content)
+            return content
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight[key]
+
+    def _fetch_attachment(self, key, url, url_params, attach, row):
+        version = self.render_version(attach) if self.persistent_cache is not None else None
+        if version is not None:
+            content = self.persistent_cache.get(key, version)
+            if content is not None:
+                print(f"Persistent render cache hit: {url} {url_params}")
+                row["status"] = "persistent_cache"
+                self.render_cache.put(key, content)
+                return content
+
+        request_params = url_params
+        if self.cfg.render_max_age_min and attach is not None and attach.ATTACHMENT_TYPE != "content":
+            # Tableau may answer from its own render cache if it is not older than maxAge minutes
+            request_params = dict(url_params, maxAge=self.cfg.render_max_age_min)
+
+        resp = self.request_render(url, request_params, row)
+        if resp.status_code != 200:
+            raise Exception(
+                f"Download of attachment fails. url: {url}, url_params: {url_params} with server response: {resp.text}"
+            )
+        else:
+            print("Successfully called: " + resp.url)
 
-        output_msg = text
-        message_loads = json.loads(subsc.MESSAGE_LOADS) if pd.notna(subsc.MESSAGE_LOADS) else {}
-        filter_loads = json.loads(subsc.FILTER_PAYLOAD) if pd.notna(subsc.FILTER_PAYLOAD) else {}
+        max_message_bytes = self.cfg.gmail_max_message_mb * 1024 * 1024
+        if self.cfg.stream_downloads:
+            content = read_streamed(resp, self.download_budget, max_message_bytes)
+            self.download_budget.hold(key, len(content))
+        else:
+            content = resp.content
+            if encoded_size(len(content)) > max_message_bytes:
+                raise UserException(
+                    f"Attachment {resp.url} has {len(content)} B and exceeds Gmail message size limit of {max_message_bytes} B."
+                )
 
-        for tag in tags_to_search:
-            if tag in message_loads:
-                output_msg = output_msg.replace("{" + tag + "}", message_loads[tag])
-            if tag in filter_loads:
-                output_msg = output_msg.replace("{" + tag + "}", str(filter_loads[tag]))
+        self.render_cache.put(key, content)
+        if version is not None:
+            self.persistent_cache.put(key, content, version)
+        return content
+
+    def request_render(self, url, request_params, row=None):
+        """GET of a render under the render concurrency limit, 429/503 and timeouts are retried (Retry-After honored)."""
+        from requests import Timeout
+
+        attempt = 0
+        while True:
+            if row is not None:
+                row["retries"] = attempt
+            self.render_limiter.acquire()
+            started = time.monotonic()
+            try:
+                resp = self.tableau.get(url, params=request_params, stream=self.cfg.stream_downloads,
+                                        timeout=self.cfg.render_timeout_s)
+            except Timeout:
+                self.render_limiter.release(overloaded=True)
+                if attempt >= self.cfg.render_max_retries:
+                    raise
+                delay = None
+            except BaseException:
+                # connection errors, failed re-sign-in – the slot must not leak
+                self.render_limiter.release(overloaded=True)
+                raise
+            else:
+                if resp.status_code not in (429, 503):
+                    self.render_limiter.release(latency=time.monotonic() - started)
+                    return resp
+                self.render_limiter.release(overloaded=True)
+                if attempt >= self.cfg.render_max_retries:
+                    return resp
+                delay = retry_after_seconds(resp.headers.get("Retry-After"))
+                resp.close()
+
+            if delay is None:
+                delay = backoff_delay(attempt, base=2.0)
+            print(f"Tableau overloaded, retry {attempt + 1}/{self.cfg.render_max_retries} of {url} in {delay:.1f} s")
+            time.sleep(delay)
+            attempt += 1
+
+    def render_version(self, attach):
+        """updated_at of the workbook which owns the attachment, None when it is unknown."""
+        if attach is None:
+            return None
+        catalog = self.tableau.catalog
+        workbook_LUID = attach.LUID
+        if attach.TABLEAU_OBJECT == "view":
+            view = catalog.views.get(attach.LUID)
+            workbook_LUID = view["workbook_id"] if view else None
+        workbook = catalog.workbooks.get(workbook_LUID)
+        return workbook["updated_at"] if workbook else None
+
+    def fanout_key(self, job):
+        """Subscribers of a 'run' email with equal subject, text and attachment params can share one message."""
+        if job.email.MODE != "run":
+            return None
+        return (job.email.EMAIL_ID,) + self.message_content(job)
+
+    def message_content(self, job):
+        """Subject, text and attachment params of the message a subscriber gets."""
+        params = tuple(json.dumps(self.compile_params(attach, job.subscriber), sort_keys=True, default=str)
+                       for attach in job.attachments)
+        return (self.compile_msg(job.email.SUBJECT, job.subscriber),
+                self.compile_msg(job.email.MESSAGE, job.subscriber),
+                params)
+
+    def delivery_key(self, job, address, subscriber):
+        """
+        Checkpoint key of one delivery – mode, the address it went to and a hash of the subscriber and
+        the message content (one address may get several messages, e.g. the owner in 'test' mode).
+        """
+        payload = json.dumps([subscriber, self.message_content(job)]).encode("utf-8")
+        return f"{job.email.MODE}|{address}|{hashlib.sha1(payload).hexdigest()[:16]}"
 
-        return output_msg
+    def compile_msg(self, text, subsc):
+        message_loads = decode_json(subsc.MESSAGE_LOADS, {})
+        filter_loads = decode_json(subsc.FILTER_PAYLOAD, {})
+        return compile_template(text).render(message_loads, filter_loads)
 
     def set_recepients(self, email, subsc):
         if email.MODE == "test":
@@ -139,8 +449,8 @@ class Driver:
             )
 
     def compile_params(self, attach, subsc):
-        filter_loads = json.loads(subsc.FILTER_PAYLOAD) if pd.notna(subsc.FILTER_PAYLOAD) else {}
-        filter_fields = json.loads(attach.FILTER_FIELDS) if pd.notna(attach.FILTER_FIELDS) else []
+        filter_loads = decode_json(subsc.FILTER_PAYLOAD, {})
+        filter_fields = decode_json(attach.FILTER_FIELDS, [])
 
         output_params = {}
         for field in filter_fields:
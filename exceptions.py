@@ -12,4 +12,16 @@ class UserException(Exception):
 class ApplicationException(Exception):
     def __init__(self, message: str):
         Exception.__init__(self, message)
-        self.message = message
\ No newline at end of file
+        self.message = message
+
+
+class BatchSendError(Exception):
+    """
+    Gmail batch sent only partly – `results` are the responses in message order (None when undelivered),
+    `errors` maps message index -> exception.
+    """
+    def __init__(self, message: str, results: list, errors: dict):
+        Exception.__init__(self, message)
+        self.message = message
+        self.results = results
+        self.errors = errors
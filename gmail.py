@@ -1,16 +1,47 @@
 import os
+import io
 import json
 import base64
 import logging
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
+from email.generator import BytesGenerator
 
+import httplib2
+import google_auth_httplib2
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2 import service_account as SACredentials
 
 from configuration import Configuration
+from exceptions import BatchSendError
+from ratelimit import backoff_delay
+
+
+class _Base64BytesGenerator(BytesGenerator):
+    """BytesGenerator, který už zakódované base64 payloady zapíše najednou místo po řádcích."""
+
+    def _handle_text(self, msg):
+        payload = msg.get_payload()
+        if (isinstance(payload, str) and str(msg.get("Content-Transfer-Encoding", "")).lower() == "base64"
+                and payload.isascii()):
+            self._fp.write(payload.encode("ascii"))
+        else:
+            super()._handle_text(msg)
+
+    # přílohy (application/*) jdou přes _writeBody
+    _writeBody = _handle_text
+
+
+RAW_CHUNK_SIZE = 3 * 256 * 1024
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+# Gmail doporučuje max. 50 požadavků v jednom batchi (hard limit je 100)
+MAX_BATCH_SIZE = 100
 
 
 class Gmail:
@@ -22,6 +53,9 @@ class Gmail:
         self.cfg = Configuration(root_directory, code_directory)
         self.creds = None
         self.service = None
+        self.max_retries = self.cfg.gmail_max_retries
+        self.retries = 0
+        self._local = threading.local()
 
     # ---------- interní utility ----------
 
@@ -51,9 +85,43 @@ class Gmail:
 
     @staticmethod
     def _mime_to_raw(message_obj: MIMEMultipart) -> dict:
-        """Převede MIME zprávu na raw base64 (formát pro Gmail API)."""
-        raw = base64.urlsafe_b64encode(message_obj.as_bytes()).decode("utf-8")
-        return {"raw": raw}
+        """
+        Převede MIME zprávu na raw base64 (formát pro Gmail API).
+        Zprávu serializujeme rovnou do bytes a kódujeme jen jednou – bez mezikopií přes str.
+        """
+        buffer = io.BytesIO()
+        _Base64BytesGenerator(buffer, mangle_from_=False, policy=message_obj.policy).flatten(message_obj)
+
+        # base64url po blocích (násobky 3 B) do předem alokovaného bufferu, serializovaná zpráva se hned uvolní
+        view = buffer.getbuffer()
+        encoded = bytearray((len(view) + 2) // 3 * 4)
+        position = 0
+        for start in range(0, len(view), RAW_CHUNK_SIZE):
+            piece = base64.urlsafe_b64encode(view[start:start + RAW_CHUNK_SIZE])
+            encoded[position:position + len(piece)] = piece
+            position += len(piece)
+        view.release()
+        buffer.close()
+        return {"raw": encoded.decode("ascii")}
+
+    @staticmethod
+    def _is_retryable(error: HttpError) -> bool:
+        """Rate limit (429, 403 rateLimitExceeded) a 5xx chyby serveru má smysl zopakovat."""
+        status = error.resp.status
+        if status in RETRYABLE_STATUS:
+            return True
+        if status == 403:
+            content = error.content.decode("utf-8", errors="replace") if isinstance(error.content, bytes) else str(error.content)
+            return any(reason in content for reason in RATE_LIMIT_REASONS)
+        return False
+
+    def _http(self):
+        """httplib2 není thread-safe – každé vlákno dostane vlastní autorizované spojení."""
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._local.http = http
+        return http
 
     # ---------- veřejné metody ----------
 
@@ -98,12 +166,15 @@ class Gmail:
 
         # Credentials + Gmail service
         self.creds = SACredentials.Credentials.from_service_account_info(clean_info, scopes=SCOPES).with_subject(user_to_impersonate)
-        self.service = build("gmail", "v1", credentials=self.creds)
+        # discovery dokument je přibalený v google-api-python-client – žádné stahování ani file cache
+        client_options = {"api_endpoint": self.cfg.gmail_api_endpoint} if self.cfg.gmail_api_endpoint else None
+        self.service = build("gmail", "v1", credentials=self.creds, static_discovery=True, cache_discovery=False,
+                             client_options=client_options)
 
         logging.info("Gmail service initialized and impersonation set.")
 
-    def construct_message(self, subject: str, to: str, text: str) -> MIMEMultipart:
-        """Sestaví jednoduchou textovou zprávu (MIME)."""
+    def construct_message(self, subject: str, to: str, text: str, bcc: str = None) -> MIMEMultipart:
+        """Sestaví jednoduchou textovou zprávu (MIME), volitelně se skrytými příjemci v `bcc`."""
         if not subject or not to or not text:
             raise ValueError("Missing required email fields: 'subject', 'to', or 'text'")
 
@@ -112,6 +183,8 @@ class Gmail:
         msg["Subject"] = subject
         msg["To"] = to
         msg["From"] = self.cfg.gmail_address
+        if bcc:
+            msg["Bcc"] = bcc
         return msg
 
     def attach_to_message(self, message: MIMEMultipart, attachment_bytes: bytes, attachment_name: str, file_type: str) -> MIMEMultipart:
@@ -133,6 +206,18 @@ class Gmail:
         message.attach(mime_base)
         return message
 
+    @property
+    def last_send(self):
+        """(odeslané bytes, počet opakování) posledního send_email / send_batch v aktuálním vlákně."""
+        return getattr(self._local, "last_send", (0, 0))
+
+    def _raw_body(self, raw_message_string: str = None, message_obj: MIMEMultipart = None) -> dict:
+        if raw_message_string is None and message_obj is None:
+            raise ValueError("Provide either 'raw_message_string' or 'message_obj'.")
+        if message_obj is not None:
+            return self._mime_to_raw(message_obj)
+        return {"raw": base64.urlsafe_b64encode(raw_message_string.encode("utf-8")).decode("utf-8")}
+
     def send_email(self, to: str, raw_message_string: str = None, message_obj: MIMEMultipart = None):
         """
         Odeslání emailu.
@@ -142,18 +227,87 @@ class Gmail:
         if not self.service:
             raise RuntimeError("Gmail service not initialized. Call gmail_login() first.")
 
-        if raw_message_string is None and message_obj is None:
-            raise ValueError("Provide either 'raw_message_string' or 'message_obj'.")
+        body = self._raw_body(raw_message_string, message_obj)
 
-        if message_obj is not None:
-            body = self._mime_to_raw(message_obj)
-        else:
-            body = {"raw": base64.urlsafe_b64encode(raw_message_string.encode("utf-8")).decode("utf-8")}
-
-        try:
-            resp = self.service.users().messages().send(userId="me", body=body).execute()
-            logging.info(f"Message sent successfully: {resp.get('id')}")
-            return resp
-        except Exception as e:
-            logging.error(f"Failed to send email: {e}")
-            raise
+        attempt = 0
+        while True:
+            try:
+                resp = self.service.users().messages().send(userId="me", body=body).execute(http=self._http())
+                logging.info(f"Message sent successfully: {resp.get('id')}")
+                self._local.last_send = (len(body["raw"]), attempt)
+                return resp
+            except HttpError as e:
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    logging.error(f"Failed to send email: {e}")
+                    raise
+                delay = backoff_delay(attempt)
+                logging.warning(f"Gmail send to {to} failed with {e.resp.status}, retry {attempt + 1}/{self.max_retries} in {delay:.1f} s")
+                self.retries += 1
+                attempt += 1
+                time.sleep(delay)
+            except Exception as e:
+                logging.error(f"Failed to send email: {e}")
+                raise
+
+    def send_batch(self, messages: list, batch_size: int = 50) -> list:
+        """
+        Odeslání více emailů přes batch API – až `batch_size` volání messages.send v jednom HTTP požadavku.
+        - `messages` je seznam dvojic (to, message_obj)
+        - výsledky i chyby se sbírají po jednotlivých zprávách, opakují se jen zprávy s chybou
+          rate limitu / serveru (exponential backoff); jiná chyba nebo vyčerpané pokusy vyhodí BatchSendError
+          s odpověďmi už doručených zpráv
+        Vrací odpovědi ve stejném pořadí jako `messages`.
+        """
+        if not self.service:
+            raise RuntimeError("Gmail service not initialized. Call gmail_login() first.")
+
+        batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        bodies = [self._raw_body(message_obj=message_obj) for to, message_obj in messages]
+        results = [None] * len(messages)
+        pending = list(range(len(messages)))
+        attempt = 0
+        retries = 0
+
+        while True:
+            errors = {}
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    errors[int(request_id)] = exception
+                else:
+                    results[int(request_id)] = response
+
+            for start in range(0, len(pending), batch_size):
+                batch = self.service.new_batch_http_request(callback=callback)
+                for index in pending[start:start + batch_size]:
+                    batch.add(self.service.users().messages().send(userId="me", body=bodies[index]), request_id=str(index))
+                try:
+                    batch.execute(http=self._http())
+                except Exception as e:
+                    # celý HTTP požadavek selhal – jeho zprávy i zbývající dávky zůstávají neodeslané
+                    for index in pending[start:]:
+                        if results[index] is None:
+                            errors.setdefault(index, e)
+                    break
+
+            if not errors:
+                logging.info(f"Batch of {len(messages)} messages sent successfully.")
+                self._local.last_send = (sum(len(body["raw"]) for body in bodies), retries)
+                return results
+
+            fatal = [e for e in errors.values() if not isinstance(e, HttpError) or not self._is_retryable(e)]
+            if fatal or attempt >= self.max_retries:
+                failed = ", ".join(messages[index][0] for index in sorted(errors))
+                error = (fatal or list(errors.values()))[0]
+                logging.error(f"Failed to send {len(errors)} of {len(messages)} batched emails ({failed}): {error}")
+                raise BatchSendError(
+                    f"Failed to send {len(errors)} of {len(messages)} batched emails: {error}", results, errors
+                ) from error
+
+            pending = sorted(errors)
+            retries += len(pending)
+            delay = backoff_delay(attempt)
+            logging.warning(f"{len(pending)} batched emails failed, retry {attempt + 1}/{self.max_retries} in {delay:.1f} s")
+            self.retries += len(pending)
+            attempt += 1
+            time.sleep(delay)
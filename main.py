@@ -4,18 +4,22 @@ print("🚀 Starting Tableau Subscriptions component...")
 
 
 import os
-import pandas as pd
 import sys
-import tableauserverclient as TSC
 import traceback
+from configuration import Configuration
 from driver import Driver
+from sharding import run_local_shards
 from exceptions import UserException, ApplicationException
 
 
 exit_codes = [1, 2, 3]
 try:
-    driver = Driver('/data', '/code/')
-    driver.run()
+    local_shards = Configuration('/data', '/code/').local_shards
+    if local_shards > 1:
+        run_local_shards('/data', '/code/', local_shards)
+    else:
+        driver = Driver('/data', '/code/')
+        driver.run()
     print("skip")
 except UserException as err:
     message = '%s' % err
@@ -0,0 +1,74 @@
+import datetime
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from ratelimit import percentile
+
+
+class RunMetrics:
+    """
+    Timings of one run – config load, filtering, catalog, logins and every download, merge and send.
+
+    Each measured step is one row with its duration, transferred bytes, retry count and status.
+    Thread-safe, rows are exported through `Writer` as the `run_metrics` output table.
+    """
+
+    COLUMNS = ["RUN_ID", "SHARD", "SEQ", "PHASE", "DETAIL", "STARTED_AT", "DURATION_MS", "BYTES", "RETRIES", "STATUS"]
+
+    def __init__(self, run_id=None, shard_index=0):
+        self.run_id = run_id or os.environ.get("KBC_RUNID") or datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
+        self.shard_index = shard_index
+        self.rows = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, detail=""):
+        """Times the block; the yielded dict may be updated with `bytes`, `retries` and `status`."""
+        row = {"bytes": 0, "retries": 0, "status": "ok"}
+        started_at = datetime.datetime.now(datetime.timezone.utc)
+        started = time.perf_counter()
+        try:
+            yield row
+        except BaseException:
+            row["status"] = "error"
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, detail, started_at=started_at, **row)
+
+    def record(self, name, seconds, detail="", bytes=0, retries=0, status="ok", started_at=None):
+        started_at = started_at or datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            self.rows.append({
+                "RUN_ID": self.run_id,
+                "SHARD": self.shard_index,
+                "SEQ": len(self.rows),
+                "PHASE": name,
+                "DETAIL": detail,
+                "STARTED_AT": started_at.isoformat(timespec="milliseconds"),
+                "DURATION_MS": round(seconds * 1000, 1),
+                "BYTES": bytes,
+                "RETRIES": retries,
+                "STATUS": status,
+            })
+
+    def to_frame(self):
+        with self._lock:
+            return pd.DataFrame(self.rows, columns=self.COLUMNS)
+
+    def summary(self):
+        with self._lock:
+            rows = list(self.rows)
+        phases = {}
+        for row in rows:
+            phases.setdefault(row["PHASE"], []).append(row)
+        lines = ["Run metrics:"]
+        for name, items in phases.items():
+            durations = [row["DURATION_MS"] for row in items]
+            lines.append(f"  {name}: {len(items)}x, total {sum(durations) / 1000:.1f} s, "
+                         f"p95 {percentile(durations, 95):.0f} ms, {sum(row['BYTES'] for row in items)} B, "
+                         f"{sum(row['RETRIES'] for row in items)} retries")
+        return "\n".join(lines)
@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+import time
+
+
+class PersistentRenderCache:
+    """
+    Render cache kept on disk between runs.
+
+    Every entry stores the `version` of the render – `updated_at` of the owning workbook – and
+    is used only while the workbook was not republished and the entry is younger than `ttl_hours`.
+    Each entry is one payload file plus one small metadata file, both replaced atomically, so
+    several processes (local shards) can share the directory.
+
+    Data refreshes (extracts, published data sources) don't change `updated_at`, so only the TTL
+    protects against stale data – keep it well below the shortest periodicity of the emails.
+    """
+
+    def __init__(self, directory, ttl_hours=4):
+        self.directory = directory
+        self.ttl = ttl_hours * 3600
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _paths(self, key):
+        return os.path.join(self.directory, f"{key}.bin"), os.path.join(self.directory, f"{key}.json")
+
+    def _expired(self, meta, version):
+        return meta.get("version") != version or time.time() - meta.get("stored_at", 0) > self.ttl
+
+    def get(self, key, version):
+        content_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if self._expired(meta, version):
+                self._remove(key)
+                self.misses += 1
+                return None
+            with open(content_path, 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return content
+
+    def put(self, key, content, version):
+        content_path, meta_path = self._paths(key)
+        self._write(content_path, content, 'wb')
+        self._write(meta_path, json.dumps({"version": version, "stored_at": time.time()}), 'w')
+
+    def _write(self, path, data, mode):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp_")
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def prune(self):
+        """Removes entries older than the TTL."""
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            try:
+                with open(os.path.join(self.directory, name), 'r') as f:
+                    stored_at = json.load(f).get("stored_at", 0)
+            except (OSError, ValueError):
+                stored_at = 0
+            if time.time() - stored_at > self.ttl:
+                self._remove(key)
+
+    def report(self):
+        return f"Persistent render cache: {self.hits} hits, {self.misses} misses"
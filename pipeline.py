@@ -0,0 +1,65 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+_DONE = object()
+
+
+class StagedPipeline:
+    """
+    Runs jobs through overlapping stages connected by bounded asyncio queues.
+
+    `stages` is a list of (name, func, workers). Every stage has its own number of workers,
+    `func` is blocking and runs in a thread pool; its result is passed to the next stage.
+    A full queue blocks the stage in front of it (backpressure), so at most `queue_size`
+    items wait between two stages. The first exception in any stage stops the whole pipeline.
+    """
+
+    def __init__(self, stages, queue_size=10):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items):
+        asyncio.run(self._run(items))
+
+    async def _run(self, items):
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=sum(workers for name, func, workers in self.stages))
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        async def feed():
+            for item in items:
+                await queues[0].put(item)
+            await queues[0].put(_DONE)
+
+        async def stage(index, func, workers):
+            inbox = queues[index]
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+
+            async def worker():
+                while True:
+                    item = await inbox.get()
+                    if item is _DONE:
+                        # let the sibling workers see the end of the stream as well
+                        await inbox.put(_DONE)
+                        return
+                    result = await loop.run_in_executor(executor, func, item)
+                    if outbox is not None:
+                        await outbox.put(result)
+
+            await asyncio.gather(*(worker() for _ in range(max(workers, 1))))
+            if outbox is not None:
+                await outbox.put(_DONE)
+
+        tasks = [asyncio.create_task(feed())]
+        tasks += [asyncio.create_task(stage(index, func, workers)) for index, (name, func, workers) in enumerate(self.stages)]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
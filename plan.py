@@ -0,0 +1,90 @@
+from collections import namedtuple
+
+import pandas as pd
+
+
+# recipients – addresses of all subscribers merged into one BCC message, None for a regular message
+Job = namedtuple("Job", ["email", "subscriber", "attachments", "recipients"], defaults=(None,))
+
+
+class SendPlan:
+    """
+    Compact list of send jobs – one per (email, subscriber) with the attachments of the email.
+
+    Subscribers and attachments are grouped once by GROUP_ID / EMAIL_ID, the plan is then built
+    in a single pass over the email queue. Like the original run loop, planning stops at the first
+    email which has subscribers but no attachments.
+    """
+
+    def __init__(self, jobs, stopped_at=None):
+        self.jobs = jobs
+        self.stopped_at = stopped_at
+
+    @classmethod
+    def build(cls, email_queue, active_subscribers, current_attachments):
+        subscribers_by_group = {
+            group_id: list(group.itertuples(index=False))
+            for group_id, group in active_subscribers.groupby("GROUP_ID", sort=False)
+        }
+        attachments_by_email = {
+            email_id: list(group.itertuples())
+            for email_id, group in current_attachments.groupby("EMAIL_ID", sort=False)
+        }
+
+        jobs = []
+        for email in email_queue.itertuples():
+            subscribers = subscribers_by_group.get(email.GROUP_ID, [])
+            if not subscribers:
+                continue
+            attachments = attachments_by_email.get(email.EMAIL_ID)
+            if not attachments:
+                print(f"""No attachment for email with EMAIL_ID: {email.EMAIL_ID}, please check input tables""")
+                return cls(jobs, stopped_at=email.EMAIL_ID)
+            jobs.extend(Job(email, subsc, attachments) for subsc in subscribers)
+
+        return cls(jobs)
+
+    def skip(self, is_done):
+        """Plan without jobs for which `is_done(job)` holds (deliveries finished by an earlier run)."""
+        return SendPlan([job for job in self.jobs if not is_done(job)], stopped_at=self.stopped_at)
+
+    def fan_out(self, key_func, max_recipients):
+        """
+        Merges jobs with equal `key_func(job)` into one job addressed to all their subscribers.
+        Jobs with key None are kept as they are; merged jobs stay at the position of their first job.
+        """
+        jobs = []
+        open_groups = {}
+        for job in self.jobs:
+            key = key_func(job)
+            if key is None:
+                jobs.append(job)
+                continue
+            position = open_groups.get(key)
+            if position is not None and len(jobs[position].recipients) < max_recipients:
+                group = jobs[position]
+                jobs[position] = group._replace(recipients=group.recipients + (job.subscriber.EMAIL,))
+            else:
+                open_groups[key] = len(jobs)
+                jobs.append(job._replace(recipients=(job.subscriber.EMAIL,)))
+
+        jobs = [job._replace(recipients=None) if job.recipients and len(job.recipients) == 1 else job for job in jobs]
+        return SendPlan(jobs, stopped_at=self.stopped_at)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        return iter(self.jobs)
+
+    def to_frame(self):
+        return pd.DataFrame(
+            [[job.email.EMAIL_ID, job.email.GROUP_ID, job.subscriber.EMAIL, len(job.attachments),
+              len(job.recipients) if job.recipients else 1] for job in self.jobs],
+            columns=["EMAIL_ID", "GROUP_ID", "EMAIL", "ATTACHMENTS", "RECIPIENTS"],
+        )
+
+    def summary(self):
+        emails = len({job.email.EMAIL_ID for job in self.jobs})
+        downloads = sum(len(job.attachments) for job in self.jobs)
+        return f"Send plan: {len(self.jobs)} messages for {emails} emails, {downloads} attachment downloads"
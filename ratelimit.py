@@ -0,0 +1,121 @@
+import datetime
+import email.utils
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. `rate` tokens are added per second up to `capacity`,
+    `acquire()` blocks until a token is available.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def backoff_delay(attempt, base=1.0, cap=64.0):
+    """Exponential backoff with full jitter for the given (0-based) retry attempt."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_after_seconds(value):
+    """Parses a Retry-After header (seconds or HTTP date), None when it is missing or invalid."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for requests to an overloadable backend.
+
+    The limit grows by one after every `window` requests whose p95 latency stays under
+    `target_latency` seconds and is halved when the p95 goes over it or when a request
+    reports overload (429/503, timeout). Callers wrap every request in acquire()/release().
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=16, target_latency=30.0, window=10):
+        self.minimum = max(int(minimum), 1)
+        self.maximum = max(int(maximum), self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.target_latency = target_latency
+        self.window = window
+        self.in_flight = 0
+        self.overloads = 0
+        self.limits = [self.limit]
+        self.latencies = []
+        self._window = []
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, overloaded=False):
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self.overloads += 1
+                self._decrease()
+            elif latency is not None:
+                self.latencies.append(latency)
+                self._window.append(latency)
+                if len(self._window) >= self.window:
+                    if percentile(self._window, 95) <= self.target_latency:
+                        self._set_limit(self.limit + 1)
+                    else:
+                        self._decrease()
+            self._cond.notify_all()
+
+    def _decrease(self):
+        self._set_limit(self.limit / 2)
+
+    def _set_limit(self, limit):
+        self.limit = float(min(max(limit, self.minimum), self.maximum))
+        self.limits.append(self.limit)
+        self._window = []
+
+    def report(self):
+        if not self.latencies:
+            return f"Render concurrency: limit {int(self.limit)}, no completed requests, {self.overloads} overloads"
+        return (f"Render concurrency: limit {int(self.limit)} (min {int(min(self.limits))}, max {int(max(self.limits))}), "
+                f"{self.overloads} overloads, latency p50 {percentile(self.latencies, 50):.1f} s, "
+                f"p95 {percentile(self.latencies, 95):.1f} s over {len(self.latencies)} requests")
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
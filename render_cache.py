@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+class RenderCache:
+    """
+    Per-run cache of Tableau renders.
+
+    Key is the attachment url together with the normalized url params, so the same
+    view / ATTACHMENT_TYPE / vf_ filter combination is downloaded only once per run.
+    Payloads are kept in memory up to `memory_budget` bytes, the rest is spilled to disk.
+    Safe to share between download threads.
+    """
+
+    def __init__(self, memory_budget=256 * 1024 * 1024, spill_directory=None):
+        self.memory_budget = memory_budget
+        self.spill_directory = spill_directory
+        self._own_spill_directory = False
+        self._memory = {}
+        self._disk = {}
+        self.memory_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(url, params):
+        normalized = json.dumps(params or {}, sort_keys=True, default=str)
+        return hashlib.sha256(f"{url}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self.hits += 1
+                return self._memory[key]
+            path = self._disk.get(key)
+            if path is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put(self, key, content):
+        with self._lock:
+            if key in self._memory or key in self._disk:
+                return
+            if self.memory_size + len(content) <= self.memory_budget:
+                self._memory[key] = content
+                self.memory_size += len(content)
+                return
+            path = os.path.join(self._spill_path(), key)
+        with open(path, 'wb') as f:
+            f.write(content)
+        with self._lock:
+            self._disk[key] = path
+
+    def _spill_path(self):
+        if self.spill_directory is None:
+            self.spill_directory = tempfile.mkdtemp(prefix="render_cache_")
+            self._own_spill_directory = True
+        os.makedirs(self.spill_directory, exist_ok=True)
+        return self.spill_directory
+
+    def report(self):
+        return (f"Render cache: {self.hits} hits, {self.misses} misses, "
+                f"{len(self._memory)} in memory ({self.memory_size} B), {len(self._disk)} on disk")
+
+    def close(self):
+        self._memory.clear()
+        self.memory_size = 0
+        if self._own_spill_directory and self.spill_directory:
+            shutil.rmtree(self.spill_directory, ignore_errors=True)
+        else:
+            for path in self._disk.values():
+                if os.path.exists(path):
+                    os.remove(path)
+        self._disk.clear()
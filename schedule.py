@@ -0,0 +1,40 @@
+def timing_table(timing_rule):
+    """Timing window name for every hour of the day (0-23), "" when no window covers the hour."""
+    table = [""] * 24
+    for hour in range(24):
+        for name, hours in timing_rule.items():
+            if hours[0] < hours[1]:
+                if hours[0] <= hour < hours[1]:
+                    table[hour] = name
+            elif hour >= hours[0] or hour < hours[1]:
+                table[hour] = name
+    return table
+
+
+class EmailSchedule:
+    """
+    EMAILS indexed by the slot in which they run.
+
+    Slots are (TIMING, "daily"), (TIMING, "weekly", weekday) and (TIMING, "monthly", day of month),
+    deprecated emails are left out. The index is built once per loaded EMAILS table, a run then
+    only looks up the slots of its timing window, weekday and day.
+    """
+
+    def __init__(self, emails):
+        self.slots = {}
+        active = emails.loc[emails.MODE != 'deprecated']
+        for index, timing, periodicity, specification in zip(active.index, active.TIMING, active.PERIODICITY,
+                                                             active.PERIODICITY_SPECIFICATION):
+            if periodicity == 'daily':
+                slot = (timing, 'daily')
+            elif periodicity in ('weekly', 'monthly'):
+                slot = (timing, periodicity, specification)
+            else:
+                continue
+            self.slots.setdefault(slot, []).append(index)
+
+    def lookup(self, timing, weekday, day):
+        """Index labels of emails due in the window, in the original EMAILS order."""
+        return sorted(self.slots.get((timing, 'daily'), [])
+                      + self.slots.get((timing, 'weekly', str(weekday)), [])
+                      + self.slots.get((timing, 'monthly', str(day)), []))
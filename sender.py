@@ -0,0 +1,128 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from exceptions import BatchSendError
+from metrics import RunMetrics
+from ratelimit import TokenBucket
+
+
+class SendPipeline:
+    """
+    Sends prepared messages through Gmail, optionally in parallel.
+
+    All sends go through a token bucket sized to the Gmail API quota. With `workers <= 1`
+    messages are sent immediately in the calling thread, otherwise they are queued to a thread
+    pool; the number of queued messages is bounded so attachments don't pile up in memory.
+    The first failed send is raised on the next `submit` or on `close`; messages of a partly
+    failed batch that were delivered are still counted and get their `on_sent`.
+
+    With `batch_size > 1` messages are collected and sent through the Gmail batch API,
+    `batch_size` messages per HTTP request.
+
+    `reserved` bytes of a message are returned to `budget` (downloader.MemoryBudget) when its send
+    ends, successfully or not.
+    """
+
+    def __init__(self, gmail, workers=1, rate=2.5, burst=5, batch_size=1, metrics=None, budget=None):
+        self.gmail = gmail
+        self.budget = budget
+        self.metrics = metrics or RunMetrics()
+        self.workers = max(int(workers), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self._buffer = []
+        self.bucket = TokenBucket(rate, burst)
+        self.sent = 0
+        self._started = None
+        self._error = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._slots = threading.BoundedSemaphore(self.workers * 2)
+
+    def submit(self, to, message_obj, on_sent=None, reserved=0):
+        if self._started is None:
+            self._started = time.monotonic()
+        self._raise_error()
+
+        self._buffer.append((to, message_obj, on_sent, reserved))
+        if len(self._buffer) >= self.batch_size:
+            self._flush()
+
+    def send(self, to, message_obj, on_sent=None, reserved=0):
+        """Sends one message right away in the calling thread (rate limit still applies). Thread-safe."""
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+        self._send([(to, message_obj, on_sent, reserved)])
+
+    def _flush(self):
+        items, self._buffer = self._buffer, []
+        if not items:
+            return
+        if self._executor is None:
+            self._send(items)
+            return
+
+        self._slots.acquire()
+        future = self._executor.submit(self._send, items)
+        future.add_done_callback(self._done)
+
+    def _send(self, items):
+        for _ in items:
+            self.bucket.acquire()
+        reserved = sum(item[3] for item in items)
+        if self.budget is not None:
+            self.budget.send_started(reserved)
+        delivered, error = items, None
+        try:
+            with self.metrics.phase("send", f"{len(items)} messages") as row:
+                if len(items) == 1:
+                    to, message_obj = items[0][:2]
+                    self.gmail.send_email(to, message_obj=message_obj)
+                else:
+                    self.gmail.send_batch([item[:2] for item in items], batch_size=self.batch_size)
+                row["bytes"], row["retries"] = self.gmail.last_send
+        except BatchSendError as err:
+            delivered = [item for item, result in zip(items, err.results) if result is not None]
+            error = err
+        finally:
+            if self.budget is not None:
+                self.budget.send_finished(reserved)
+        with self._lock:
+            self.sent += len(delivered)
+        for to, message_obj, on_sent, _ in delivered:
+            if on_sent is not None:
+                on_sent()
+        if error is not None:
+            raise error
+
+    def _done(self, future):
+        self._slots.release()
+        if future.exception() is not None:
+            with self._lock:
+                if self._error is None:
+                    self._error = future.exception()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self, cancel=False):
+        if cancel:
+            self._buffer = []
+        elif self._error is None:
+            self._flush()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=cancel or self._error is not None)
+            self._executor = None
+        if not cancel:
+            self._raise_error()
+
+    def report(self):
+        elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+        rate = self.sent / elapsed if elapsed > 0 else 0.0
+        return f"Gmail: sent {self.sent} messages in {elapsed:.1f} s ({rate:.2f} msg/s)"
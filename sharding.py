@@ -0,0 +1,56 @@
+import json
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from state import State
+
+
+def shard_of(key, shard_count):
+    """Stable shard number of a key – the same in every process and on every machine."""
+    return zlib.crc32(str(key).encode("utf-8")) % shard_count
+
+
+def shard_mask(email_queue, shard_index, shard_count, shard_by="email"):
+    """Boolean mask of emails which belong to `shard_index`, split by EMAIL_ID or by GROUP_ID."""
+    column = "GROUP_ID" if shard_by == "group" else "EMAIL_ID"
+    return email_queue[column].map(lambda key: shard_of(key, shard_count) == shard_index).astype(bool)
+
+
+def shard_state_name(shard_index):
+    return f"state.shard{shard_index}.json"
+
+
+def _run_shard(root_directory, code_directory, shard_index, shard_count):
+    from driver import Driver
+    return Driver(root_directory, code_directory, shard_index=shard_index, shard_count=shard_count).run()
+
+
+def run_local_shards(root_directory, code_directory, shard_count):
+    """
+    Runs all shards of the queue in parallel processes on this machine.
+    Every shard writes its own state file, they are merged into out/state.json at the end.
+    """
+    # fork – main.py has no __main__ guard, spawned children would run it again
+    context = multiprocessing.get_context("fork")
+    try:
+        with ProcessPoolExecutor(max_workers=shard_count, mp_context=context) as executor:
+            futures = [executor.submit(_run_shard, root_directory, code_directory, shard_index, shard_count)
+                       for shard_index in range(shard_count)]
+            for future in futures:
+                future.result()
+    finally:
+        merge_shard_states(root_directory, shard_count)
+
+
+def merge_shard_states(root_directory, shard_count):
+    state = State(root_directory)
+    for shard_index in range(shard_count):
+        path = os.path.join(root_directory, "out", shard_state_name(shard_index))
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            state.merge(json.load(f))
+        os.remove(path)
+    state.write()
@@ -0,0 +1,49 @@
+import json
+import os
+import threading
+
+
+class State:
+    """
+    Keboola state file – read from `in/state.json`, written to `out/state.json`.
+    Keboola hands the written state back to the next run of the configuration.
+    """
+
+    def __init__(self, root_directory="/data", out_name="state.json"):
+        self.in_path = os.path.join(root_directory, "in", "state.json")
+        self.out_path = os.path.join(root_directory, "out", out_name)
+        self.data = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.in_path):
+            try:
+                with open(self.in_path, 'r') as f:
+                    self.data = json.load(f) or {}
+            except Exception as e:
+                print(f"Unable to read state file, starting with empty state: {e}")
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self.data[key] = value
+
+    def merge(self, data):
+        """Merges state written by another process (local shard) into this one, deliveries of all shards are kept."""
+        deliveries = self.data.get("deliveries") or {}
+        for date, emails in (data.get("deliveries") or {}).items():
+            for email_id, keys in emails.items():
+                merged = set(deliveries.get(date, {}).get(email_id, [])).union(keys)
+                deliveries.setdefault(date, {})[email_id] = sorted(merged)
+        self.data.update(data)
+        if deliveries:
+            self.data["deliveries"] = deliveries
+
+    def write(self):
+        # one fixed tmp path – writes from several threads must not interleave
+        with self._lock:
+            os.makedirs(os.path.dirname(self.out_path), exist_ok=True)
+            tmp_path = self.out_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.out_path)
@@ -0,0 +1,46 @@
+import functools
+import json
+import re
+
+import pandas as pd
+
+
+TAG_PATTERN = re.compile(r"{[^\s]+}")
+TAG_NAME_PATTERN = re.compile(r"[^{}]+")
+
+
+class MessageTemplate:
+    """
+    SUBJECT / MESSAGE text with {tag} placeholders, parsed once.
+
+    Tags are replaced from MESSAGE_LOADS first and FILTER_PAYLOAD second, in the order
+    in which they occur in the text.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tags = [TAG_NAME_PATTERN.search(tag).group(0) for tag in TAG_PATTERN.findall(text)]
+
+    def render(self, message_loads, filter_loads):
+        output_msg = self.text
+        for tag in self.tags:
+            if tag in message_loads:
+                output_msg = output_msg.replace("{" + tag + "}", message_loads[tag])
+            if tag in filter_loads:
+                output_msg = output_msg.replace("{" + tag + "}", str(filter_loads[tag]))
+        return output_msg
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(text):
+    return MessageTemplate(text)
+
+
+@functools.lru_cache(maxsize=65536)
+def _decode_json(payload):
+    return json.loads(payload)
+
+
+def decode_json(payload, default):
+    """Decodes a JSON column value, repeated payloads are decoded only once. Results must not be modified."""
+    return _decode_json(payload) if pd.notna(payload) else default
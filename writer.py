@@ -7,23 +7,25 @@ import re
 
 
 class Writer:
-    def __init__(self, configuration, table_name):
+    def __init__(self, configuration, table_name, incremental=None, part_prefix=""):
         self.table_name = table_name
         self.cfg = configuration
         self.part_number = 0
+        # local shards write into the same sliced table, each with its own part names
+        self.part_prefix = part_prefix
+        self.table_path = os.path.join(self.cfg.root, "out", "tables", f"{self.table_name}.csv")
         # get metadata for the table
         self.header = configuration.schemas["tables"][
             next((index for (index, d) in enumerate(configuration.schemas["tables"]) if d["name"] == table_name),
                  None)]
         # create csv folder if non-existent
-        if not os.path.exists(f"{self.cfg.root}out/tables/{self.table_name}.csv/"):
-            os.makedirs(f"{self.cfg.root}out/tables/{self.table_name}.csv/")
+        os.makedirs(self.table_path, exist_ok=True)
         # create a manifest file if non-existent
-        if not os.path.exists(f"{self.cfg.root}out/tables/{self.table_name}.csv.manifest"):
-            self.cfg.cfg.write_table_manifest(f"{self.cfg.root}out/tables/{self.table_name}.csv",
-                                              columns=self.header["columns"],
-                                              primary_key=self.header["primary_keys"],
-                                              incremental = self.cfg.incremental)
+        if not os.path.exists(f"{self.table_path}.manifest"):
+            self.cfg.write_table_manifest(self.table_path,
+                                          columns=self.header["columns"],
+                                          primary_key=self.header["primary_keys"],
+                                          incremental=self.cfg.incremental if incremental is None else incremental)
 
     def __rename_and_reduce_columns(self, data_frame):
         #pattern = re.compile(r'\.')
@@ -40,7 +42,7 @@ class Writer:
         #    table_data = self.__rename_and_reduce_columns(table_data)
         # write one partial csv to the csv folder
         if table_data is not None and not table_data.empty:
-            table_data.to_csv(f"{self.cfg.root}out/tables/{self.table_name}.csv/part{self.part_number}",
+            table_data.to_csv(os.path.join(self.table_path, f"{self.part_prefix}part{self.part_number}"),
                               header=False,
                               index=False)
             self.part_number += 1